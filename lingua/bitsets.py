@@ -0,0 +1,246 @@
+import collections
+
+
+def bits(mask):
+    """
+    Yields the indexes of all the bits set in the given mask.
+    """
+    while mask:
+        lowest = mask & -mask
+        yield lowest.bit_length() - 1
+        mask ^= lowest
+
+
+class BitsetAnalysis(object):
+    """
+    An alternative to the set based nullable, FIRST, FOLLOW and predict set
+    computations in Grammar.
+
+    Terminals are numbered by their position in Grammar.terminalsByIndex
+    (with the EOF token taking the position right after the last terminal)
+    and non terminals by their position in Grammar.nonTerminalsByIndex.
+    Every set is then stored as a single integer bitmask so that unions and
+    comparisons are done a machine word at a time instead of by hashing
+    symbol names.
+
+    The results are exposed through the same API as the Grammar (nullables,
+    firstSets, followSets and evalPredictSets) and are converted back to sets
+    of Symbols only when asked for.  The raw masks are also available via
+    the *Masks methods.
+    """
+    def __init__(self, grammar):
+        self.grammar = grammar
+        self.terminals = list(grammar.terminalsByIndex) + [grammar.eofToken]
+        self.nonTerminals = list(grammar.nonTerminalsByIndex)
+        self.termIndexes = dict((t.name, i) for i, t in enumerate(self.terminals))
+        self.nonTermIndexes = dict((nt.name, i) for i, nt in enumerate(self.nonTerminals))
+        self.eofMask = 1 << (len(self.terminals) - 1)
+
+        # codes[id] is the (isTerminal, index) pair for the symbol with the
+        # given id in the grammar
+        codes = [None] * len(grammar.symbolsById)
+        for index, term in enumerate(self.terminals):
+            codes[term.id] = (True, index)
+        for index, nonterm in enumerate(self.nonTerminals):
+            codes[nonterm.id] = (False, index)
+
+        # Encode each production as (lhs, production, rhs) where rhs is a list of
+        # (isTerminal, index, isOptional) tuples
+        self.productions = []
+        for lhs, nonterm in enumerate(self.nonTerminals):
+            for prod in grammar.productionsFor(nonterm):
+                rhs = []
+                for su in prod.rhs:
+                    symbol = su.symbol
+                    if 0 <= symbol.id < len(codes) and grammar.symbolsById[symbol.id] is symbol:
+                        isTerm, index = codes[symbol.id]
+                    elif symbol.name in self.nonTermIndexes:
+                        isTerm, index = False, self.nonTermIndexes[symbol.name]
+                    else:
+                        isTerm, index = True, self.termIndexes[symbol.name]
+                    rhs.append((isTerm, index, su.isOptional))
+                self.productions.append((lhs, prod, rhs))
+
+        self._nullableMask = None
+        self._firstMasks = None
+        self._followMasks = {}
+
+    def termSet(self, mask):
+        return set(self.terminals[i] for i in bits(mask))
+
+    def nonTermSet(self, mask):
+        return set(self.nonTerminals[i] for i in bits(mask))
+
+    def nullableMask(self):
+        """
+        Returns the mask of nullable non terminals.
+        """
+        if self._nullableMask is not None:
+            return self._nullableMask
+
+        mask = 0
+        changed = True
+        while changed:
+            changed = False
+            for lhs, prod, rhs in self.productions:
+                if mask & (1 << lhs):
+                    continue
+                for isTerm, index, isOptional in rhs:
+                    if not isOptional and (isTerm or not mask & (1 << index)):
+                        break
+                else:
+                    mask |= 1 << lhs
+                    changed = True
+        self._nullableMask = mask
+        return mask
+
+    def firstMasks(self):
+        """
+        Returns a list of FIRST set masks indexed by non terminal index.
+        """
+        if self._firstMasks is not None:
+            return self._firstMasks
+
+        nullable = self.nullableMask()
+        first = [0] * len(self.nonTerminals)
+
+        # users[B] lists the productions whose FIRST set depends on FIRST(B)
+        users = [[] for nt in self.nonTerminals]
+        for prod in self.productions:
+            for isTerm, index, isOptional in prod[2]:
+                if isTerm:
+                    if not isOptional:
+                        break
+                else:
+                    users[index].append(prod)
+                    if not isOptional and not nullable & (1 << index):
+                        break
+
+        queue = collections.deque(self.productions)
+        while queue:
+            lhs, prod, rhs = queue.popleft()
+            fmask = first[lhs]
+            for isTerm, index, isOptional in rhs:
+                if isTerm:
+                    fmask |= 1 << index
+                    if not isOptional:
+                        break
+                else:
+                    fmask |= first[index]
+                    if not isOptional and not nullable & (1 << index):
+                        break
+            if fmask != first[lhs]:
+                first[lhs] = fmask
+                queue.extend(users[lhs])
+        self._firstMasks = first
+        return first
+
+    def suffixMasks(self, rhs):
+        """
+        Given an encoded production rhs returns two lists, firstFrom and
+        nullableFrom, such that firstFrom[i] is the mask of FIRST(rhs[i:]) and
+        nullableFrom[i] is True if rhs[i:] is nullable.  Both lists have one
+        more entry than the rhs for the empty suffix.
+        """
+        nullable = self.nullableMask()
+        first = self.firstMasks()
+        n = len(rhs)
+        firstFrom = [0] * (n + 1)
+        nullableFrom = [True] * (n + 1)
+        for i in xrange(n - 1, -1, -1):
+            isTerm, index, isOptional = rhs[i]
+            if isTerm:
+                fmask = 1 << index
+                isNullable = isOptional
+            else:
+                fmask = first[index]
+                isNullable = isOptional or bool(nullable & (1 << index))
+            if isNullable:
+                fmask |= firstFrom[i + 1]
+            firstFrom[i] = fmask
+            nullableFrom[i] = isNullable and nullableFrom[i + 1]
+        return firstFrom, nullableFrom
+
+    def followMasks(self, startnt=None):
+        """
+        Returns a dictionary of FOLLOW set masks keyed by the index of each
+        non terminal reachable from the start symbol.
+        """
+        start = self.nonTermIndexes[self.grammar.startSymbol(startnt).name]
+        if start in self._followMasks:
+            return self._followMasks[start]
+
+        byLhs = collections.defaultdict(list)
+        for prod in self.productions:
+            byLhs[prod[0]].append(prod)
+
+        follow = {start: self.eofMask}
+        # edges[A] is the list of non terminals B such that FOLLOW(A) is a
+        # subset of FOLLOW(B)
+        edges = collections.defaultdict(list)
+        queue = collections.deque([start])
+        while queue:
+            lhs = queue.popleft()
+            for _, prod, rhs in byLhs[lhs]:
+                firstFrom, nullableFrom = self.suffixMasks(rhs)
+                for i, (isTerm, index, isOptional) in enumerate(rhs):
+                    if isTerm:
+                        continue
+                    if index not in follow:
+                        follow[index] = 0
+                        queue.append(index)
+                    follow[index] |= firstFrom[i + 1]
+                    if nullableFrom[i + 1]:
+                        edges[lhs].append(index)
+
+        queue = collections.deque(follow.keys())
+        while queue:
+            source = queue.popleft()
+            fmask = follow[source]
+            for target in edges[source]:
+                if follow[target] | fmask != follow[target]:
+                    follow[target] |= fmask
+                    queue.append(target)
+        self._followMasks[start] = follow
+        return follow
+
+    @property
+    def nullables(self):
+        return self.nonTermSet(self.nullableMask())
+
+    @property
+    def firstSets(self):
+        out = {}
+        for index, fmask in enumerate(self.firstMasks()):
+            out[self.nonTerminals[index]] = self.termSet(fmask)
+        for term in self.grammar.terminalsByIndex:
+            out[term] = set((term,))
+        return out
+
+    def followSets(self, startnt=None):
+        out = collections.defaultdict(set)
+        for index, fmask in self.followMasks(startnt).iteritems():
+            out[self.nonTerminals[index]] = self.termSet(fmask)
+        return out
+
+    def followSetsFor(self, startnts):
+        return dict((startnt, self.followSets(startnt)) for startnt in startnts)
+
+    def predictMasks(self, startnt=None):
+        """
+        Returns a list of (production, predict set mask) tuples for every
+        production in the grammar.
+        """
+        follow = self.followMasks(startnt)
+        out = []
+        for lhs, prod, rhs in self.productions:
+            firstFrom, nullableFrom = self.suffixMasks(rhs)
+            pmask = firstFrom[0]
+            if nullableFrom[0]:
+                pmask |= follow.get(lhs, 0)
+            out.append((prod, pmask))
+        return out
+
+    def evalPredictSets(self, startnt=None):
+        for prod, pmask in self.predictMasks(startnt):
+            prod.setPredictSet(self.termSet(pmask))
@@ -0,0 +1,302 @@
+"""
+Compiled grammars.
+
+A compiled grammar is a compact binary snapshot of a Grammar along with its
+precomputed nullables, FIRST sets and the FOLLOW sets for its start symbol
+so that an unchanged .pg file does not have to be tokenized, parsed and
+analysed again.
+
+The layout (all integers are little endian 32 bit) is:
+
+    magic       4 bytes ("LNGC")
+    version     format version
+    hash        20 byte SHA1 of the grammar source
+    checksum    CRC32 of the rest of the file
+    lengths     number of items in each of the sections below
+    sections    the integer sections, in SECTIONS order
+    strings     the bytes of all the strings referred to by index
+
+Symbols, productions and symbol usages are encoded as fixed size records of
+indexes into the string and symbol tables and the analysis sets as lists of
+symbol indexes.  Files are memory mapped and the sections read straight out
+of the mapping.
+"""
+import array
+import collections
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+import grammar
+import utils
+
+MAGIC = "LNGC"
+VERSION = 2
+HEADER = struct.Struct("<4sI20sI")
+
+# Sections of the file, in order
+SECTIONS = ("stringOffsets",    # start of each string (plus the end of the last)
+            "symbols",          # (name, resultType, isTerminal) per symbol
+            "productions",      # (lhs, handler, first usage, num usages)
+            "usages",           # (symbol, varname, isOptional) per usage
+            "nullables",        # symbols
+            "firstOffsets",     # start of each non terminal's FIRST set
+            "firstItems",       # symbols
+            "followKeys",       # non terminals with a FOLLOW set
+            "followOffsets",    # start of each FOLLOW set
+            "followItems")      # symbols (EOF_INDEX for the EOF token)
+LENGTHS = struct.Struct("<%dI" % len(SECTIONS))
+
+NONE_INDEX = -1
+EOF_INDEX = -2
+
+
+def intArray(values=()):
+    out = array.array("i", values)
+    assert out.itemsize == 4, "Compiled grammars need 32 bit ints"
+    return out
+
+
+def sourceHash(source):
+    """
+    Returns the SHA1 digest of the given grammar source.
+    """
+    return hashlib.sha1(source).digest()
+
+
+def cachePath(cachedir, digest):
+    return os.path.join(cachedir, digest.encode("hex") + ".lgc")
+
+
+class StringTable(object):
+    def __init__(self):
+        self.indexes = {}
+        self.strings = []
+
+    def add(self, value):
+        if value is None:
+            return NONE_INDEX
+        if value not in self.indexes:
+            self.indexes[value] = len(self.strings)
+            self.strings.append(value)
+        return self.indexes[value]
+
+
+def save(G, outfile, digest):
+    """
+    Writes the compiled form of the grammar G (whose source has the given
+    digest) to outfile.  FOLLOW sets are saved for the default start symbol.
+    """
+    strings = StringTable()
+    symbols = G.terminalsByIndex + G.nonTerminalsByIndex
+    symbolIndexes = dict((symbol.name, index) for index, symbol in enumerate(symbols))
+
+    def itemIndex(symbol):
+        # the EOF token in the analysis sets is not one of the grammar's
+        # symbols, though a terminal of the grammar may have the same name
+        if symbol is G.eofToken or symbol.name not in symbolIndexes:
+            return EOF_INDEX
+        return symbolIndexes[symbol.name]
+
+    sections = dict((name, intArray()) for name in SECTIONS)
+    for symbol in symbols:
+        sections["symbols"].extend((strings.add(symbol.name),
+                                    strings.add(symbol.resultType),
+                                    int(symbol.isTerminal)))
+
+    usages = sections["usages"]
+    for nonterm in G.nonTerminalsByIndex:
+        for prod in G.productionsFor(nonterm):
+            sections["productions"].extend((symbolIndexes[nonterm.name],
+                                            strings.add(prod.handler),
+                                            len(usages) / 3,
+                                            prod.rhs.numSymbols))
+            for su in prod.rhs:
+                usages.extend((symbolIndexes[su.symbol.name],
+                               strings.add(su.varname),
+                               int(su.isOptional)))
+
+    sections["nullables"].extend(itemIndex(nt) for nt in G.nullables)
+    firstSets = G.firstSets
+    for nonterm in G.nonTerminalsByIndex:
+        sections["firstOffsets"].append(len(sections["firstItems"]))
+        sections["firstItems"].extend(itemIndex(t) for t in firstSets[nonterm])
+    sections["firstOffsets"].append(len(sections["firstItems"]))
+
+    if G.nonTerminalsByIndex:
+        for nonterm, fset in G.followSets().iteritems():
+            sections["followKeys"].append(symbolIndexes[nonterm.name])
+            sections["followOffsets"].append(len(sections["followItems"]))
+            sections["followItems"].extend(itemIndex(t) for t in fset)
+    sections["followOffsets"].append(len(sections["followItems"]))
+
+    offset = 0
+    for value in strings.strings:
+        sections["stringOffsets"].append(offset)
+        offset += len(value)
+    sections["stringOffsets"].append(offset)
+
+    body = [LENGTHS.pack(*[len(sections[name]) for name in SECTIONS])]
+    body.extend(sections[name].tostring() for name in SECTIONS)
+    body.append("".join(strings.strings))
+    checksum = 0
+    for chunk in body:
+        checksum = zlib.crc32(chunk, checksum)
+    outfile.write(HEADER.pack(MAGIC, VERSION, digest, checksum & 0xffffffff))
+    for chunk in body:
+        outfile.write(chunk)
+
+
+def load(infile, digest=None):
+    """
+    Reads a compiled grammar from the given file.  Returns None if the file
+    is not a compiled grammar of this version, is truncated or corrupt or
+    (if a digest is given) was not compiled from a source with the given
+    digest.
+    """
+    size = os.fstat(infile.fileno()).st_size
+    if size < HEADER.size + LENGTHS.size:
+        return None
+    data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, version, filedigest, checksum = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            return None
+        if digest is not None and filedigest != digest:
+            return None
+        if zlib.crc32(buffer(data, HEADER.size)) & 0xffffffff != checksum:
+            return None
+        lengths = LENGTHS.unpack_from(data, HEADER.size)
+        offset = HEADER.size + LENGTHS.size
+        if offset + 4 * sum(lengths) > size:
+            return None
+
+        sections = {}
+        for name, length in zip(SECTIONS, lengths):
+            sections[name] = struct.unpack_from("<%di" % length, data, offset)
+            offset += 4 * length
+        stringOffsets = sections["stringOffsets"]
+        if not stringOffsets or stringOffsets[0] != 0 or offset + stringOffsets[-1] != size or \
+                any(stringOffsets[i] > stringOffsets[i + 1] for i in xrange(len(stringOffsets) - 1)):
+            return None
+        strings = [data[offset + stringOffsets[i]:offset + stringOffsets[i + 1]]
+                   for i in xrange(len(stringOffsets) - 1)]
+    except struct.error:
+        return None
+    finally:
+        data.close()
+    try:
+        return build(sections, strings)
+    except (AssertionError, IndexError, KeyError, TypeError, ValueError):
+        # indexes that point outside their tables
+        return None
+
+
+def build(sections, strings):
+    """
+    Creates the Grammar described by the decoded sections of a compiled
+    grammar.  Raises ValueError if an index or offset in the sections is
+    out of range.
+    """
+    def checkIndex(index, length):
+        # negative indexes would silently wrap around
+        if not 0 <= index < length:
+            raise ValueError("Index %d out of range" % index)
+        return index
+
+    def checkOffsets(offsets, count, total):
+        if len(offsets) != count + 1 or offsets[0] != 0 or offsets[-1] != total or \
+                any(offsets[i] > offsets[i + 1] for i in xrange(count)):
+            raise ValueError("Invalid offsets")
+
+    def string(index):
+        return None if index == NONE_INDEX else strings[checkIndex(index, len(strings))]
+
+    def symbol(index):
+        return symbols[checkIndex(index, len(symbols))]
+
+    def item(index):
+        return G.eofToken if index == EOF_INDEX else symbol(index)
+
+    for name, size in (("symbols", 3), ("productions", 4), ("usages", 3)):
+        if len(sections[name]) % size:
+            raise ValueError("Truncated %s section" % name)
+
+    G = grammar.Grammar()
+    symbols = []
+    entries = sections["symbols"]
+    for i in xrange(0, len(entries), 3):
+        name, resultType = string(entries[i]), string(entries[i + 1])
+        if name is None:
+            raise ValueError("Symbol without a name")
+        if entries[i + 2]:
+            symbols.append(G.addTerminal(name, resultType))
+        else:
+            symbols.append(G.addNonTerminal(name, resultType))
+
+    usages = sections["usages"]
+    numUsages = len(usages) / 3
+    entries = sections["productions"]
+    for i in xrange(0, len(entries), 4):
+        nonterm = symbol(entries[i])
+        start, count = entries[i + 2], entries[i + 3]
+        if nonterm.isTerminal or start < 0 or count < 0 or start + count > numUsages:
+            raise ValueError("Invalid production")
+        rhs = grammar.SymbolString.fromUsages(
+            [G.symbolUsage(symbol(usages[3 * u]),
+                           string(usages[3 * u + 1]),
+                           bool(usages[3 * u + 2]))
+             for u in xrange(start, start + count)])
+        G.addProduction(nonterm, grammar.Production(nonterm, rhs, string(entries[i + 1])))
+
+    # Install the precomputed analyses
+    nonterms = G.nonTerminalsByIndex
+    offsets, items = sections["firstOffsets"], sections["firstItems"]
+    checkOffsets(offsets, len(nonterms), len(items))
+    firstSets = {}
+    for index, nonterm in enumerate(nonterms):
+        firstSets[nonterm] = set(item(i) for i in items[offsets[index]:offsets[index + 1]])
+    for term in G.terminalsByIndex:
+        firstSets[term] = set((term,))
+
+    follow = collections.defaultdict(set)
+    offsets, items = sections["followOffsets"], sections["followItems"]
+    checkOffsets(offsets, len(sections["followKeys"]), len(items))
+    for index, key in enumerate(sections["followKeys"]):
+        follow[symbol(key)] = set(item(i) for i in items[offsets[index]:offsets[index + 1]])
+
+    G.setModified()
+    G._nullables = set(symbol(i) for i in sections["nullables"])
+    G._firstSets = firstSets
+    if nonterms:
+        G._followSets = {nonterms[0]: follow}
+    return G
+
+
+def loadCached(filepath, cachedir, parser):
+    """
+    Returns the grammar in the given .pg file, loading it from its compiled
+    form in cachedir if one exists for the current contents of the file.
+    Otherwise the file is parsed with the given parser function (which takes
+    the source) and the compiled form is saved to the cache.
+    """
+    with open(filepath, "rb") as infile:
+        source = infile.read()
+    digest = sourceHash(source)
+    path = cachePath(cachedir, digest)
+    if os.path.exists(path):
+        with open(path, "rb") as infile:
+            G = load(infile, digest)
+        if G is not None:
+            return G
+
+    G = parser(source)
+    utils.ensureDir(cachedir)
+    # write to a temporary file first so readers never see partial files
+    fd, temppath = tempfile.mkstemp(dir=cachedir, suffix=".tmp")
+    with os.fdopen(fd, "wb") as outfile:
+        save(G, outfile, digest)
+    os.rename(temppath, path)
+    return G
@@ -1,24 +1,36 @@
 import graph
+import bitsets
 import collections
+import contextlib
+import heapq
 from utils import enumeratex, TrieNode
 
 
 class Symbol(object):
+    """
+    A terminal or non terminal.  Symbols are interned by the grammar they are
+    added to, which gives each one a small integer id (see
+    Grammar.symbolsById).
+    """
+    __slots__ = ("id", "index", "name", "isTerminal", "resultType")
+
     def __init__(self, name, resultType=None):
+        self.id = -1
         self.index = -1
         self.name = name
-        self._isTerminal = True
+        self.isTerminal = True
         self.resultType = resultType
 
     def copy(self):
         out = Symbol(self.name, self.resultType)
         out.isTerminal = self.isTerminal
         out.index = self.index
+        out.id = self.id
         return out
 
     def __cmp__(self, other):
         if type(other) is str:
-            other = Symbol(other)
+            return cmp(self.name, other)
         return cmp(self.name, other.name)
 
     def __hash__(self):
@@ -30,20 +42,20 @@ class Symbol(object):
         else:
             return "%s" % self.name
 
-    @property
-    def isTerminal(self):
-        return self._isTerminal
-
-    @isTerminal.setter
-    def isTerminal(self, val):
-        self._isTerminal = val
-
     @property
     def isNonTerminal(self):
-        return not self._isTerminal
+        return not self.isTerminal
 
 
 class SymbolUsage(object):
+    """
+    An occurrence of a symbol in a production.  Usages created through
+    Grammar.symbolUsage (and copies made for a grammar) are shared by all
+    occurrences with the same symbol, varname and optional flag so they must
+    not be modified.
+    """
+    __slots__ = ("symbol", "varname", "isOptional")
+
     def __init__(self, symbol, varname=None, isOptional=False):
         self.symbol = symbol
         self.varname = varname
@@ -53,10 +65,10 @@ class SymbolUsage(object):
         return cmp(self.symbol, other.symbol)
 
     def copy(self, grammar=None):
-        outsym = self.symbol
         if grammar:
-            outsym = grammar.symbolByName(self.symbol.name)
-        return SymbolUsage(outsym, self.varname, self.isOptional)
+            return grammar.symbolUsage(grammar.symbolByName(self.symbol.name),
+                                       self.varname, self.isOptional)
+        return SymbolUsage(self.symbol, self.varname, self.isOptional)
 
     @property
     def isTerminal(self):
@@ -75,77 +87,109 @@ class SymbolUsage(object):
 class SymbolString(list):
     """
     A symbol string.
+
+    Which symbols are optional is kept as a bitmap (bit i is set if the i'th
+    symbol is optional) so checking whether a prefix or suffix of the string
+    is entirely optional is a single mask comparison.  The bitmap is only
+    marked as stale by mutations and rebuilt when it is next needed, so
+    building a string one symbol at a time stays linear.
     """
+    __slots__ = ("_optionalMask",)
+
     def __init__(self, symbols=None):
         super(SymbolString, self).__init__()
         self.extend(symbols)
 
+    @classmethod
+    def fromUsages(cls, usages):
+        """
+        Creates a symbol string from a list of SymbolUsage instances without
+        validating each of them.
+        """
+        out = cls()
+        list.extend(out, usages)
+        return out
+
     def validate(self, symbol):
-        if type(symbol) is str:
+        if type(symbol) is SymbolUsage:
+            return symbol
+        elif type(symbol) is str:
             return SymbolUsage(Symbol(symbol))
         elif type(symbol) is Symbol:
             return SymbolUsage(symbol)
-        elif type(symbol) is SymbolUsage:
-            return symbol
         else:
             raise Exception("Only strings or Symbol types are allowed")
 
     def revalOptionals(self):
-        symbols = self
-        self._numSymbols = len(symbols)
-        # optionalTo[i] is True if symbols 0 to i (inclusive) are ALL optional
-        # optionalFrom[i] is True if symbols i to end (inclusive) are ALL optional
-        isOptional = [su.isOptional for su in symbols]
-        optionalTo = isOptional[:]
-        optionalFrom = isOptional[:]
-        for index, _ in enumerate(optionalTo):
-            optionalTo[index] = symbols[index].isOptional
-            if index > 0:
-                optionalTo[index] = optionalTo[index] and optionalTo[index - 1]
-        for i in xrange(self.numSymbols - 1, -1, -1):
-            optionalFrom[i] = symbols[i].isOptional
-            if i < self.numSymbols - 1:
-                optionalFrom[i] = optionalFrom[i] and optionalFrom[i + 1]
-        self.optionalTo = optionalTo
-        self.optionalFrom = optionalFrom
+        """
+        Rebuilds the optional bitmap.  This must be called if the isOptional
+        flag of a symbol usage already in this string is modified.
+        """
+        mask = 0
+        bit = 1
+        for su in self:
+            if su.isOptional:
+                mask |= bit
+            bit <<= 1
+        self._optionalMask = mask
+
+    @property
+    def optionalMask(self):
+        if self._optionalMask is None:
+            self.revalOptionals()
+        return self._optionalMask
 
     def append(self, symbol):
         symbol = self.validate(symbol)
         super(SymbolString, self).append(symbol)
-        self.revalOptionals()
+        self._optionalMask = None
 
     def insert(self, index, symbol):
         symbol = self.validate(symbol)
         super(SymbolString, self).insert(index, symbol)
-        self.revalOptionals()
+        self._optionalMask = None
 
     def remove(self, symbol):
         super(SymbolString, self).remove(symbol)
-        self.revalOptionals()
+        self._optionalMask = None
 
     def extend(self, symbols):
-        symbols = symbols or []
-        for index, symbol in enumerate(symbols):
-            symbols[index] = self.validate(symbol)
-        super(SymbolString, self).extend(symbols)
-        self.revalOptionals()
+        if symbols:
+            validate = self.validate
+            super(SymbolString, self).extend([validate(symbol) for symbol in symbols])
+        self._optionalMask = None
 
     def copy(self, grammar=None):
-        return SymbolString([s.copy(grammar) for s in self])
+        return SymbolString.fromUsages([s.copy(grammar) for s in self])
 
     def isOptionalTo(self, index):
+        """
+        Returns True if symbols 0 to index (inclusive) are ALL optional.
+        """
         if index < 0:
             return True
-        return self.optionalTo[index]
+        prefix = (1 << (index + 1)) - 1
+        return self.optionalMask & prefix == prefix
 
     def isOptionalFrom(self, index):
+        """
+        Returns True if symbols index to end (inclusive) are ALL optional.
+        """
         if index >= len(self):
             return True
-        return self.optionalFrom[index]
+        return self.optionalMask >> index == (1 << (len(self) - index)) - 1
+
+    @property
+    def optionalTo(self):
+        return [self.isOptionalTo(i) for i in xrange(len(self))]
+
+    @property
+    def optionalFrom(self):
+        return [self.isOptionalFrom(i) for i in xrange(len(self))]
 
     @property
     def numSymbols(self):
-        return self._numSymbols
+        return len(self)
 
     def __repr__(self):
         return " ".join(map(str, self))
@@ -157,24 +201,31 @@ class SymbolString(list):
         # result = self.symbols[index]
         result = super(SymbolString, self).__getitem__(index)
         if type(index) is slice:
-            result = SymbolString(result)
+            result = SymbolString.fromUsages(result)
         return result
 
     def __setitem__(self, index, symbol):
-        if type(symbol) is str:
-            symbol = SymbolUsage(symbol)
-        elif type(symbol) is list:
-            symbols = symbol
-            for index, symbol in enumerate(symbols):
-                if type(symbol) is str:
-                    symbols[index] = SymbolUsage(symbol)
-            symbol = symbols
+        if type(index) is slice:
+            symbol = [self.validate(s) for s in symbol]
+        else:
+            symbol = self.validate(symbol)
         super(SymbolString, self).__setitem__(index, symbol)
-        self.revalOptionals()
-        # self.symbols[index] = symbol
+        self._optionalMask = None
+
+    def __setslice__(self, start, end, symbols):
+        self.__setitem__(slice(start, end), symbols)
+
+    def __delitem__(self, index):
+        super(SymbolString, self).__delitem__(index)
+        self._optionalMask = None
+
+    def __delslice__(self, start, end):
+        self.__delitem__(slice(start, end))
 
 
 class Production(object):
+    __slots__ = ("nonterm", "rhs", "handler", "predictSet")
+
     def __init__(self, nonterm, rhs, handler=None):
         self.nonterm = nonterm
         if type(rhs) is list:
@@ -211,8 +262,7 @@ class Production(object):
             return []
 
         su = self.rhs[start]
-        newsu = su.copy(grammar)
-        newsu.isOptional = False
+        newsu = grammar.symbolUsage(grammar.symbolByName(su.symbol.name), su.varname)
         rest = self.removeNullInProduction(grammar, start + 1)
         rest = rest or [[]]
         rest_with_sym = [[newsu] + r for r in rest]
@@ -223,6 +273,66 @@ class Production(object):
             return rest + rest_with_sym
 
 
+class OccurrenceIndex(object):
+    """
+    A reverse index of the productions of a grammar by the symbols in their
+    right hand sides, ie for every symbol (name) the productions that use it
+    and the productions that start with it.  Productions are listed in the
+    order they were indexed.
+
+    The symbols each production was indexed under are remembered so it can be
+    unindexed (or reindexed) even after its symbols are modified in place.
+    """
+    def __init__(self):
+        self.using = collections.defaultdict(dict)
+        self.startingWith = collections.defaultdict(dict)
+        self.indexed = {}
+        self.counter = 0
+
+    def add(self, production):
+        key = id(production)
+        if key in self.indexed:
+            self.remove(production)
+        symbols = tuple(set(su.symbol.name for su in production.rhs))
+        first = production.rhs[0].symbol.name if production.rhs else None
+        self.indexed[key] = (symbols, first)
+        # entries carry a sequence number to list productions in order
+        self.counter += 1
+        entry = (self.counter, production)
+        for symbol in symbols:
+            self.using[symbol][key] = entry
+        if first is not None:
+            self.startingWith[first][key] = entry
+
+    def remove(self, production):
+        key = id(production)
+        if key not in self.indexed:
+            return
+        symbols, first = self.indexed.pop(key)
+        for symbol in symbols:
+            prods = self.using[symbol]
+            del prods[key]
+            if not prods:
+                del self.using[symbol]
+        if first is not None:
+            prods = self.startingWith[first]
+            del prods[key]
+            if not prods:
+                del self.startingWith[first]
+
+    def productionsUsing(self, symbol):
+        name = getattr(symbol, "name", symbol)
+        if name in self.using:
+            return [prod for seq, prod in sorted(self.using[name].itervalues())]
+        return []
+
+    def productionsStartingWith(self, symbol):
+        name = getattr(symbol, "name", symbol)
+        if name in self.startingWith:
+            return [prod for seq, prod in sorted(self.startingWith[name].itervalues())]
+        return []
+
+
 class ProductionList(object):
     """
     ProductionLists are an easy way to maintain a group of productions instead
@@ -233,18 +343,84 @@ class ProductionList(object):
     1. Provide easy ordered iteration as one would do with lists.
     2. Efficient searching of existing/duplicate productions
     3. Allow storage of duplicate productions
+
+    If an OccurrenceIndex is given it is kept up to date with the productions
+    in this list.
     """
-    def __init__(self, nonterm, productions=None):
+    def __init__(self, nonterm, productions=None, occurrences=None):
         self.nonterm = nonterm
         self.productions = productions or []
-        self.prodsByPrefix = TrieNode()
+        self.occurrences = occurrences
+        self.reindex()
+
+    @classmethod
+    def productionKey(cls, symbols, handler=None):
+        """
+        Returns the key by which productions are indexed, ie the names of the
+        symbols in the production along with the production's handler.
+        """
+        names = []
+        for symbol in symbols:
+            if type(symbol) is str:
+                names.append(symbol)
+            elif type(symbol) is SymbolUsage:
+                names.append(symbol.symbol.name)
+            else:
+                names.append(symbol.name)
+        return tuple(names), handler
+
+    def reindex(self):
+        """
+        Rebuilds the index of productions.  This must be called if the
+        symbols of any of the productions in this list are modified in place.
+        """
+        self.prodsByKey = collections.defaultdict(list)
+        self._prodsByPrefix = None
+        for prod in self.productions:
+            self.index(prod)
+
+    @property
+    def prodsByPrefix(self):
+        """
+        A prefix tree of the productions keyed by their symbol names.  It is
+        only needed by prefix queries (eg for left factoring) so it is built
+        when first asked for and dropped whenever the productions change.
+        """
+        if self._prodsByPrefix is None:
+            trie = TrieNode()
+            for prod in self.productions:
+                trie.insert(self.productionKey(prod.rhs)[0], prod)
+            self._prodsByPrefix = trie
+        return self._prodsByPrefix
+
+    def index(self, production):
+        key = self.productionKey(production.rhs, production.handler)
+        self.prodsByKey[key].append(production)
+        self._prodsByPrefix = None
+        if self.occurrences is not None:
+            self.occurrences.add(production)
+
+    def unindex(self, production):
+        if self.occurrences is not None:
+            self.occurrences.remove(production)
+        key = self.productionKey(production.rhs, production.handler)
+        self._prodsByPrefix = None
+        prods = self.prodsByKey[key]
+        for index, prod in enumerate(prods):
+            if prod is production:
+                del prods[index]
+                break
+        if not prods:
+            del self.prodsByKey[key]
 
     def copy(self, grammar=None):
         nonterm = self.nonterm
+        occurrences = None
         if grammar:
             nonterm = grammar.symbolByName(self.nonterm.name)
+            occurrences = grammar._occurrences
         prodcopy = [p.copy(grammar) for p in self.productions]
-        return ProductionList(nonterm, prodcopy)
+        return ProductionList(nonterm, prodcopy, occurrences)
 
     def __repr__(self):
         return " ; ".join(map(repr, self.productions))
@@ -252,26 +428,18 @@ class ProductionList(object):
     def addProduction(self, production):
         production.nonterm = self.nonterm
         # add production if not a duplicate
-        for prod in self.productions:
-            if prod.handler == production.handler and \
-                    prod.rhs.numSymbols == production.rhs.numSymbols:
-                # check if symbols are same:
-                found = True
-                for sym1, sym2 in zip(prod.rhs, production.rhs):
-                    if cmp(sym1, sym2) != 0:
-                        found = False
-                        break
-                if found:
-                    return
+        if self.findProduction(production.rhs, production.handler):
+            return
+        self.index(production)
         self.productions.append(production)
 
     def removeProduction(self, production):
         if type(production) is int:
-            del self.productions[production]
+            del self[production]
         else:
-            for index, prod in self.productions:
-                if prod == production:
-                    del self.productions[index]
+            for index, prod in enumerate(self.productions):
+                if prod is production:
+                    del self[index]
                     break
 
     def removeNullProductions(self, grammar):
@@ -286,7 +454,7 @@ class ProductionList(object):
         for index in xrange(len(self.productions) - 1, -1, -1):
             prod = self.productions[index]
             if prod.rhs.numSymbols == 0:
-                del self.productions[index]
+                del self[index]
 
     def removeCycles(self, grammar, cycles=None):
         """
@@ -304,16 +472,31 @@ class ProductionList(object):
         return self.productions[index]
 
     def __setitem__(self, index, prod):
+        self.unindex(self.productions[index])
+        prod.nonterm = self.nonterm
         self.productions[index] = prod
+        self.index(prod)
 
     def __delitem__(self, index):
+        prod = self.productions[index]
         del self.productions[index]
+        self.unindex(prod)
 
-    def findProduction(self, symbols):
+    def productionsWithPrefix(self, symbols):
         """
-        Returns a production that has the same symbols in the given list
+        Returns the productions whose right hand side starts with the given
+        symbols.
         """
-        pass
+        names = self.productionKey(symbols)[0]
+        return list(self.prodsByPrefix.valuesWithPrefix(names))
+
+    def findProduction(self, symbols, handler=None):
+        """
+        Returns a production that has the same symbols in the given list (and
+        the same handler) if one exists, otherwise None.
+        """
+        prods = self.prodsByKey.get(self.productionKey(symbols, handler))
+        return prods[0] if prods else None
 
 
 class Reduction(object):
@@ -331,7 +514,12 @@ class Grammar(object):
         self.terminalsByIndex = []
         self.nonTerminalsByIndex = []
         self.productions = {}
-        self.eofToken = Grammar.EOF
+        self._occurrences = None
+        self.symbolsById = []
+        self.eofToken = self.internSymbol(Grammar.EOF.copy())
+        self._batchDepth = 0
+        # interned symbol usages keyed by (symbol name, varname, isOptional)
+        self._usages = {}
         self.setModified()
 
     @property
@@ -339,34 +527,208 @@ class Grammar(object):
         return self._modified
 
     def setModified(self):
+        """
+        Drops all derived analyses so they are recomputed from scratch the
+        next time they are asked for.
+        """
         self._firstSets = None
         self._followSets = None
         self._nullables = None
+        self._dependents = None
+        self._suffixFirsts = None
+        self._bitsets = None
+        self._addedFor = set()
+        self._removedFor = set()
+        self._modified = True
+
+    @contextlib.contextmanager
+    def batchUpdates(self):
+        """
+        Groups a series of production additions and removals so that the
+        derived analyses are brought up to date only once, when the outermost
+        batch ends.  Until then cached analyses are left as they were when the
+        batch started.
+
+            with G.batchUpdates():
+                G.addProduction(...)
+                G.removeProduction(...)
+        """
+        self._batchDepth += 1
+        try:
+            yield self
+        finally:
+            self._batchDepth -= 1
+            if self._batchDepth == 0:
+                self.updateAnalyses()
+
+    def productionsChanged(self, nonterm, removed=False):
+        """
+        Notes that productions of the given non terminal have been added (or
+        removed or modified if removed is True) so only the analyses that
+        depend on them are recomputed.
+        """
         self._modified = True
+        self._followSets = None
+        self._suffixFirsts = None
+        self._bitsets = None
+        if removed:
+            self._removedFor.add(nonterm)
+        else:
+            self._addedFor.add(nonterm)
+        if self._batchDepth == 0:
+            self.updateAnalyses()
+
+    @property
+    def dependents(self):
+        """
+        Returns a map of each non terminal B to the set of non terminals that
+        have B somewhere in their productions, ie the non terminals whose
+        nullability and FIRST sets may depend on those of B.
+        """
+        if self._dependents is None:
+            out = collections.defaultdict(set)
+            for nonterm, prod in self.allProductions():
+                for su in prod.rhs:
+                    if su.isNonTerminal:
+                        out[su.symbol].add(nonterm)
+            self._dependents = out
+        return self._dependents
+
+    def updateAnalyses(self):
+        """
+        Brings the cached nullables and FIRST sets up to date with the
+        production changes noted since the last update.
+
+        Additions can only grow the analyses so re-evaluating the changed non
+        terminals (and propagating to their dependents) reaches the new
+        fixpoint.  Removals can shrink them so the entries of the changed non
+        terminals and everything that transitively depends on them are reset
+        first.  Everything else derived from the productions (eg FOLLOW sets)
+        is dropped, including anything computed during a batch.
+        """
+        added, removed = self._addedFor, self._removedFor
+        self._addedFor, self._removedFor = set(), set()
+        if not (added or removed):
+            return
+        # analyses cached during a batch were computed from the old
+        # productions
+        self._followSets = None
+        self._suffixFirsts = None
+        self._bitsets = None
+        nullables = self._nullables
+        firstSets = self._firstSets
+        if nullables is None:
+            return
+
+        dependents = self.dependents
+        for nonterm in removed:
+            # productions may have been modified in place so make sure their
+            # symbols are known to depend on them
+            for prod in self.productionsFor(nonterm):
+                for su in prod.rhs:
+                    if su.isNonTerminal:
+                        dependents[su.symbol].add(nonterm)
+
+        stale = set(removed)
+        queue = collections.deque(removed)
+        while queue:
+            nonterm = queue.popleft()
+            for dep in dependents[nonterm]:
+                if dep not in stale:
+                    stale.add(dep)
+                    queue.append(dep)
+        for nonterm in stale:
+            nullables.discard(nonterm)
+            if firstSets is not None:
+                firstSets[nonterm] = set()
+        pending = added | stale
+
+        queue = collections.deque(pending)
+        while queue:
+            nonterm = queue.popleft()
+            pending.discard(nonterm)
+            changed = False
+            if nonterm not in nullables:
+                for prod in self.productionsFor(nonterm):
+                    if all(su.isOptional or su.symbol in nullables
+                           for su in prod.rhs):
+                        nullables.add(nonterm)
+                        changed = True
+                        break
+            if firstSets is not None:
+                fset = firstSets.setdefault(nonterm, set())
+                size = len(fset)
+                for prod in self.productionsFor(nonterm):
+                    for su in prod.rhs:
+                        fset.update(firstSets[su.symbol])
+                        if not su.isOptional and su.symbol not in nullables:
+                            break
+                changed = changed or len(fset) != size
+            if changed:
+                for dep in dependents[nonterm]:
+                    if dep not in pending:
+                        pending.add(dep)
+                        queue.append(dep)
 
     def copy(self):
         out = Grammar()
         out.eofToken = self.eofToken.copy()
 
-        # copy symbols first
+        # copy symbols first (retaining their ids)
         out.terminalsByIndex = [t.copy() for t in self.terminalsByIndex]
         out.nonTerminalsByIndex = [nt.copy() for nt in self.nonTerminalsByIndex]
         for term in out.terminalsByIndex:
             out.terminalsByName[term.name] = term
         for nonterm in out.nonTerminalsByIndex:
             out.nonTerminalsByName[nonterm.name] = nonterm
+        out.symbolsById = [None] * len(self.symbolsById)
+        for symbol in [out.eofToken] + out.terminalsByIndex + out.nonTerminalsByIndex:
+            out.symbolsById[symbol.id] = symbol
 
         # copy productions
-        for name, productions in self.productions.iteritems():
-            out.productions[name] = productions.copy(self)
+        for nonterm, productions in self.productions.iteritems():
+            out.productions[out.symbolByName(nonterm.name)] = productions.copy(out)
         return out
 
+    def internSymbol(self, symbol):
+        """
+        Gives a symbol an id that is unique within this grammar so that
+        symbolsById[symbol.id] is symbol.
+        """
+        if not 0 <= symbol.id < len(self.symbolsById) or \
+                self.symbolsById[symbol.id] is not symbol:
+            symbol.id = len(self.symbolsById)
+            self.symbolsById.append(symbol)
+        return symbol
+
+    def symbolUsage(self, symbol, varname=None, isOptional=False):
+        """
+        Returns a usage of the given symbol.  Usages are interned so every
+        occurrence of a symbol with the same varname and optional flag shares
+        a single instance, which must therefore not be modified.
+        """
+        key = (symbol.name, varname, isOptional)
+        usage = self._usages.get(key)
+        if usage is None or usage.symbol is not symbol:
+            usage = self._usages[key] = SymbolUsage(symbol, varname, isOptional)
+        return usage
+
     def symbolByName(self, name):
         if name in self.terminalsByName:
             return self.terminalsByName[name]
         else:
             return self.nonTerminalsByName[name]
 
+    def startSymbol(self, startnt=None):
+        """
+        Returns the start non terminal given its name or symbol.  If no
+        start symbol is given then the first non terminal is returned.
+        """
+        startnt = startnt or self.nonTerminalsByIndex[0]
+        if type(startnt) is str:
+            startnt = self.nonTerminalsByName[startnt]
+        return startnt
+
     def isTerminal(self, symbol):
         return symbol in self.terminalsByName
 
@@ -383,11 +745,15 @@ class Grammar(object):
         else:
             assert symbol.name not in self.nonTerminalsByName, "Symbol is already classified as a non terminal"
         if symbol.name not in self.terminalsByName:
+            self.internSymbol(symbol)
             self.terminalsByName[symbol.name] = symbol
             self.terminalsByIndex.append(symbol)
         symbol = self.terminalsByName[symbol]
         symbol.isTerminal = True
-        self.setModified()
+        self._modified = True
+        self._bitsets = None
+        if self._firstSets is not None and symbol not in self._firstSets:
+            self._firstSets[symbol] = set((symbol,))
         return symbol
 
     def addNonTerminal(self, symbol, resultType=None):
@@ -399,29 +765,44 @@ class Grammar(object):
             else:
                 symbol = Symbol(symbol, resultType)
         if symbol.name in self.terminalsByName:
+            # existing usages of the symbol change meaning
             del self.terminalsByName[symbol.name]
             index = self.terminalsByIndex.index(symbol)
             del self.terminalsByIndex[index]
+            self.setModified()
         if symbol.name not in self.nonTerminalsByName:
+            self.internSymbol(symbol)
             self.nonTerminalsByIndex.append(symbol)
         self.nonTerminalsByName[symbol.name] = symbol
         symbol.isTerminal = False
-        self.setModified()
+        self._modified = True
+        self._bitsets = None
+        if self._firstSets is not None and symbol not in self._firstSets:
+            self._firstSets[symbol] = set()
         return symbol
 
     def addProduction(self, nonterm, production):
         production.nonterm = nonterm
         if nonterm not in self.productions:
-            self.productions[nonterm] = ProductionList(nonterm)
+            self.productions[nonterm] = ProductionList(nonterm, occurrences=self._occurrences)
         self.productions[nonterm].addProduction(production)
-        self.setModified()
+        if self._dependents is not None:
+            for su in production.rhs:
+                if su.isNonTerminal:
+                    self._dependents[su.symbol].add(nonterm)
+        self.productionsChanged(nonterm)
 
-    def findProduction(self, nonterm, symbols):
+    def removeProduction(self, nonterm, production):
+        """
+        Removes a production (or the production at the given index) from the
+        productions of a non terminal.
+        """
+        self.productions[nonterm].removeProduction(production)
+        self.productionsChanged(nonterm, removed=True)
+
+    def findProduction(self, nonterm, symbols, handler=None):
         if nonterm in self.productions:
-            productions = self.productions[nonterm]
-            for prod in productions:
-                if prod.matchesSymbols(symbols):
-                    return prod
+            return self.productions[nonterm].findProduction(symbols, handler)
         return None
 
     def allProductions(self):
@@ -438,6 +819,47 @@ class Grammar(object):
         else:
             return []
 
+    @property
+    def occurrences(self):
+        """
+        Returns the OccurrenceIndex of the productions in this grammar.  It is
+        built when first asked for and from then on kept up to date by the
+        production lists as productions are added and removed.
+        """
+        if self._occurrences is None:
+            index = OccurrenceIndex()
+            for prodlist in self.productions.itervalues():
+                prodlist.occurrences = index
+                for prod in prodlist:
+                    index.add(prod)
+            self._occurrences = index
+        return self._occurrences
+
+    def productionsUsing(self, symbol):
+        """
+        Returns the productions (of any non terminal) that have the given
+        symbol anywhere in their right hand side.
+        """
+        return self.occurrences.productionsUsing(symbol)
+
+    def productionsStartingWith(self, symbol):
+        """
+        Returns the productions (of any non terminal) whose right hand side
+        starts with the given symbol.
+        """
+        return self.occurrences.productionsStartingWith(symbol)
+
+    @property
+    def bitsets(self):
+        """
+        Returns the bitset based analysis engine for this grammar.  It offers
+        the same nullables, firstSets, followSets and evalPredictSets API as
+        the grammar itself.
+        """
+        if self._bitsets is None:
+            self._bitsets = bitsets.BitsetAnalysis(self)
+        return self._bitsets
+
     @property
     def nullables(self):
         """
@@ -445,37 +867,39 @@ class Grammar(object):
         """
         if self._nullables is not None:
             return self._nullables
-        out = set()
-        for name, nonterm in self.nonTerminalsByName.iteritems():
-            # first find all non terms that already have a
-            # production with only null
-            for prod in self.productionsFor(nonterm):
-                if prod.rhs is None or prod.rhs.numSymbols == 0:
-                    out.add(nonterm)
-
-        # Find productions now that are of the form:
-        # Y -> X
-        # where X is a nullable (as per step 1) or is optional
-        for name, nonterm in self.nonTerminalsByName.iteritems():
-            if nonterm not in out:
-                for prod in self.productionsFor(nonterm):
-                    if prod.rhs.numSymbols == 1:
-                        symbol = prod.rhs[0].symbol
-                        if prod.rhs[0].isOptional or  \
-                                (symbol.isNonTerminal and symbol in out):
-                            out.add(nonterm)
-                            break
 
-        # Finally for all productions of the form:
-        # Y -> A B C ... N
-        # add Y to the nullable list if all of A, B and C are nullable
-        for name, nonterm in self.nonTerminalsByName.iteritems():
-            if nonterm not in out:
-                for prod in self.productionsFor(nonterm):
-                    if all([su.isOptional or su.symbol in
-                            out for su in prod.rhs]):
-                        out.add(nonterm)
-                        break
+        # A production is nullable once all its symbols are optional or
+        # nullable so keep a count of the symbols in each production that are
+        # not known to be nullable yet.  Productions with a required terminal
+        # can never be nullable and are skipped altogether.  Every time a non
+        # terminal is found to be nullable the counts of the productions using
+        # it are decremented so each symbol occurrence is visited only once.
+        lhs = []
+        counts = []
+        occurrences = collections.defaultdict(list)
+        queue = collections.deque()
+        for nonterm, prod in self.allProductions():
+            required = [su.symbol for su in prod.rhs if not su.isOptional]
+            if any(symbol.isTerminal for symbol in required):
+                continue
+            if not required:
+                queue.append(nonterm)
+            index = len(counts)
+            for symbol in required:
+                occurrences[symbol].append(index)
+            lhs.append(nonterm)
+            counts.append(len(required))
+
+        out = set()
+        while queue:
+            nonterm = queue.popleft()
+            if nonterm in out:
+                continue
+            out.add(nonterm)
+            for index in occurrences[nonterm]:
+                counts[index] -= 1
+                if counts[index] == 0:
+                    queue.append(lhs[index])
         self._nullables = out
         return out
 
@@ -487,169 +911,277 @@ class Grammar(object):
         nullables = self.nullables
         out = {}
 
-        # Now look at productions of the form:
-        # A -> a B   (ie first symbol is a terminal)
-        for name, nonterm in self.nonTerminalsByName.iteritems():
-            fset = out[nonterm] = set()
-            for prod in self.productionsFor(nonterm):
-                if prod.rhs.numSymbols > 0:
-                    symbol = prod.rhs[0].symbol
-                    if symbol.isTerminal:
-                        fset.add(symbol)
-
         # First set of terminals is the terminal itself
         for name, symbol in self.terminalsByName.iteritems():
             out[symbol] = set((symbol,))
 
-        def dfs(nonterm, populated, fsets, nullables):
-            fset = fsets[nonterm]
-            if nonterm in populated:
-                return fset
-            populated.add(nonterm)
+        # For each non terminal A find the terminals that can directly start
+        # it and the non terminals B it can start with, ie productions of the
+        # form:
+        #
+        #   A -> alpha B beta
+        #
+        # where alpha is nullable (so FIRST(B) is a subset of FIRST(A)).
+        direct = {}
+        startsWith = {}
+        for nonterm in self.nonTerminalsByIndex:
+            terms = direct[nonterm] = set()
+            starts = startsWith[nonterm] = []
             for prod in self.productionsFor(nonterm):
                 for symUsage in prod.rhs:
                     symbol = symUsage.symbol
                     if symbol.isTerminal:
-                        fset.add(symbol)
+                        terms.add(symbol)
                         if not symUsage.isOptional:
                             # no more FIRSTs in this production
                             break
                     else:
-                        # add FIRST set to curr nonterm's first set
-                        dfs(symbol, populated, fsets, nullables)
-                        fset.update(fsets[symbol])
-                        if symbol not in nullables:
+                        starts.append(symbol)
+                        if not symUsage.isOptional and symbol not in nullables:
                             break
 
-        # Now go through all productions of the form:
-        #   A -> X Y Z
-        # First(A) would contain First(X Y Z)
-        # First(X Y Z) would contain First(X) + First(Y Z) if X is nullable
-        # and so on
-        for nonterm in self.nonTerminalsByName:
-            dfs(nonterm, set(), out, nullables)
+        # Non terminals in the same strongly connected component of the
+        # "starts with" graph have the same FIRST set.  Components come out of
+        # tarjan in reverse topological order, so the FIRST sets of all the
+        # components a component can start with are complete by the time it
+        # is reached and one union per component gives its exact FIRST set.
+        sccs = graph.tarjan(self.nonTerminalsByIndex, lambda nonterm: startsWith.get(nonterm, ()))
+        for scc in sccs:
+            fset = set()
+            for nonterm in scc:
+                fset.update(direct.get(nonterm, ()))
+                for symbol in startsWith.get(nonterm, ()):
+                    if symbol in out:
+                        fset.update(out[symbol])
+            # each member gets its own copy as they are updated individually
+            # by updateAnalyses
+            for nonterm in scc:
+                out[nonterm] = set(fset)
         self._firstSets = out
         return out
 
     def followSets(self, startnt=None):
-        startnt = startnt or self.nonTerminalsByIndex[0]
-        if type(startnt) is str:
-            startnt = self.nonTerminalsByName[startnt]
+        """
+        Returns the FOLLOW sets of the non terminals reachable from the given
+        start symbol.  The result is cached per start symbol until the grammar
+        is modified.
+        """
+        startnt = self.startSymbol(startnt)
+        return self.followSetsFor([startnt])[startnt]
+
+    def followSetsFor(self, startnts):
+        """
+        Returns a dictionary mapping each of the given start symbols to its
+        FOLLOW sets (as returned by followSets).  Start symbols whose FOLLOW
+        sets are not cached yet are all computed together in a single pass.
+        """
+        startnts = [self.startSymbol(startnt) for startnt in startnts]
+        if self._followSets is None:
+            self._followSets = {}
+        missing = []
+        for startnt in startnts:
+            if startnt not in self._followSets and startnt not in missing:
+                missing.append(startnt)
+        if missing:
+            self._followSets.update(self.evalFollowSets(missing))
+        return dict((startnt, self._followSets[startnt]) for startnt in startnts)
+
+    def evalFollowSets(self, startnts):
+        """
+        Computes the FOLLOW sets for each of the given start symbols.
+        """
+        # A single pass over the productions seeds the FOLLOW sets with the
+        # FIRST sets of the suffixes following each non terminal and records
+        # the edges A -> B (ie FOLLOW(A) is a subset of FOLLOW(B)) for
+        # productions of the form:
+        #
+        #   A -> alpha B beta
+        #
+        # where beta is nullable.  Seeds are kept along with the non terminal
+        # whose production they came from as they only count for start symbols
+        # that can reach it.
+        seeds = collections.defaultdict(list)
+        edges = collections.defaultdict(set)
+        uses = collections.defaultdict(set)
+        for nonterm, prod in self.allProductions():
+            suffixes = self.suffixFirsts(prod.rhs)
+            for i, symUsage in enumerate(prod.rhs):
+                symbol = symUsage.symbol
+                if symbol.isNonTerminal:
+                    uses[nonterm].add(symbol)
+                    firstFrom, nullableFrom = suffixes[i + 1]
+                    if firstFrom:
+                        seeds[symbol].append((nonterm, firstFrom))
+                    if nullableFrom:
+                        edges[nonterm].add(symbol)
+
+        reachable = {}
+        for startnt in startnts:
+            visited = reachable[startnt] = set((startnt,))
+            queue = collections.deque([startnt])
+            while queue:
+                for symbol in uses[queue.popleft()]:
+                    if symbol not in visited:
+                        visited.add(symbol)
+                        queue.append(symbol)
+
+        # Non terminals in the same strongly connected component of the edge
+        # graph share the same FOLLOW set.  Visiting the components in
+        # topological order means each component only has to be unioned and
+        # pushed along its outgoing edges once for every start symbol.
+        # Components are either wholly reachable from a start symbol or not
+        # at all.
+        out = dict((startnt, collections.defaultdict(set)) for startnt in startnts)
+        nodes = self.nonTerminalsByIndex + startnts
+        sccs = graph.tarjan(nodes, lambda nonterm: edges[nonterm])
+        for scc in reversed(sccs):
+            for startnt in startnts:
+                visited = reachable[startnt]
+                if scc[0] not in visited:
+                    continue
+                follow = out[startnt]
+                fset = set()
+                for nonterm in scc:
+                    if nonterm == startnt:
+                        fset.add(self.eofToken)
+                    if nonterm in follow:
+                        fset.update(follow[nonterm])
+                    for lhs, firstFrom in seeds[nonterm]:
+                        if lhs in visited:
+                            fset.update(firstFrom)
+                for nonterm in scc:
+                    follow[nonterm] = set(fset)
+                for nonterm in scc:
+                    for target in edges[nonterm]:
+                        follow[target].update(fset)
+        return out
+
+    def suffixFirsts(self, symbols):
+        """
+        Returns a list with the (FIRST set, nullable) pair of every suffix of
+        the given symbols, ie entry i is for symbols[i:] and the last entry is
+        for the empty suffix.  Symbols can be SymbolUsages, Symbols or symbol
+        names.
+
+        The list is built in a single right to left pass and memoized per
+        string (every production's rhs is a string) until the nullables or
+        FIRST sets change, so the FOLLOW and predict set computations only
+        build it once.  Consecutive suffixes share the same FIRST set object
+        unless a symbol adds new terminals to it and each symbol's own FIRST
+        set is frozen only once.  The FIRST sets are frozensets and must not
+        be modified.
+        """
+        key = []
+        for symbol in symbols:
+            if type(symbol) is SymbolUsage:
+                key.append((symbol.symbol.name, symbol.isOptional))
+            elif type(symbol) is Symbol:
+                key.append((symbol.name, False))
+            else:
+                key.append((symbol, False))
+        key = tuple(key)
+
+        memo = self._suffixFirsts
+        if memo is None:
+            memo = self._suffixFirsts = {}
+        if key in memo:
+            return memo[key]
 
         nullables = self.nullables
         firstSets = self.firstSets
+        empty = frozenset()
+        firstFrom, nullableFrom = empty, True
+        out = [(firstFrom, nullableFrom)]
+        for usage in reversed(key):
+            # the entry of a single symbol string holds its frozen FIRST set
+            single = memo.get((usage,))
+            if single is None:
+                name, isOptional = usage
+                symbol = self.symbolByName(name)
+                single = memo[(usage,)] = [(frozenset(firstSets.get(symbol, ())),
+                                            isOptional or symbol in nullables),
+                                           (empty, True)]
+            fset, isNullable = single[0]
+            if not isNullable:
+                firstFrom, nullableFrom = fset, False
+            elif not fset <= firstFrom:
+                firstFrom = firstFrom | fset
+            out.append((firstFrom, nullableFrom))
+        out.reverse()
+        memo[key] = out
+        return out
 
-        follow = collections.defaultdict(set)
-        follow[startnt] = set((self.eofToken,))
+    def firstOfString(self, symbols):
+        """
+        Returns the FIRST set of a string of symbols (SymbolUsages, Symbols or
+        symbol names).
+        """
+        return self.suffixFirsts(symbols)[0][0]
 
-        def visit(follow):
-            queue = [startnt]
-            visited = {}
-            numAdded = 0
-            while queue:
-                nonterm = queue.pop(0)
-                if nonterm not in visited:
-                    visited[nonterm] = True
-                    for prod in self.productionsFor(nonterm):
-                        nUsages = prod.rhs.numSymbols
-                        nullableFrom = [False] * nUsages
-                        firstFrom = [set() for i in xrange(0, nUsages)]
-                        for i in xrange(nUsages - 1, -1, -1):
-                            symUsage = prod.rhs[i]
-                            symbol = symUsage.symbol
-                            if symbol.isNonTerminal and symbol not in visited:
-                                queue.append(symbol)
-
-                            isNullable = symbol in nullables or symUsage.isOptional
-                            firstFrom[i].update(firstSets[symbol])
-                            if i == nUsages - 1:
-                                nullableFrom[i] = isNullable
-                                if nullableFrom[i] and symbol.isNonTerminal:
-                                    # last symbol AND it is nullable so add
-                                    # Follow[nonterm] to Folow[symbol]
-                                    # since symUsage is nullable
-                                    size = len(follow[symbol])
-                                    follow[symbol].update(follow[nonterm])
-                                    numAdded += len(follow[symbol]) - size
-                            else:
-                                nullableFrom[i] = isNullable and nullableFrom[i + 1]
-                                if isNullable:
-                                    firstFrom[i].update(firstFrom[i + 1])
-                                if symbol.isNonTerminal:
-                                    size = len(follow[symbol])
-                                    follow[symbol].update(firstFrom[i + 1])
-                                    numAdded += len(follow[symbol]) - size
-                                if nullableFrom[i + 1]:
-                                    size = len(follow[symbol])
-                                    follow[symbol].update(follow[nonterm])
-                                    numAdded += len(follow[symbol]) - size
-            return numAdded
-        while True:
-            n = visit(follow)
-            print "Num Added: ", n
-            if n == 0:
-                break
-        return follow
+    def isNullableString(self, symbols):
+        """
+        Tells if a string of symbols can derive the empty string.
+        """
+        return self.suffixFirsts(symbols)[0][1]
 
     def evalPredictSets(self, startnt=None):
-        nullables = self.nullables
-        firstSets = self.firstSets
         followSets = self.followSets(startnt)
         for nonterm, prod in self.allProductions():
-            nUsages = prod.rhs.numSymbols
-            nullableFrom = [False] * nUsages
-            firstFrom = [set() for i in xrange(0, nUsages)]
-            for i in xrange(nUsages - 1, -1, -1):
-                symUsage = prod.rhs[i]
-                symbol = symUsage.symbol
-                isNullable = symbol in nullables or symUsage.isOptional
-                firstFrom[i].update(firstSets[symbol])
-                nullableFrom[i] = isNullable
-                if i < nUsages - 1 and isNullable:
-                    nullableFrom[i] = isNullable and nullableFrom[i + 1]
-                    firstFrom[i].update(firstFrom[i + 1])
-
-            pset = set()
-            if nUsages > 0:
-                pset.update(firstFrom[0])
-                if nullableFrom[0]:
-                    pset.update(followSets[nonterm])
-            else:
+            firstFrom, nullable = self.suffixFirsts(prod.rhs)[0]
+            pset = set(firstFrom)
+            if nullable:
                 pset.update(followSets[nonterm])
             prod.setPredictSet(pset)
-            if pset:
-                print "Prod: %s, predSet: [%s]" % (prod, " ".join(map(str, list(pset))))
-            else:
-                print "Prod: %s, predSet: []" % prod
+
+    def cycleEdges(self, node):
+        """
+        Returns the edge of the given nonterm
+        For a nt such that:
+
+            S -> alpha1 X1 beta1 |
+                 alpha2 X2 beta2 |
+                 ...
+                 alphaN XN betaN |
+
+        S's neighbouring nodes would be Xk if all of alphak is optional
+        AND all of betak is optional
+        """
+        for prod in self.productionsFor(node):
+            for i, su in enumerate(prod.rhs):
+                rhs = prod.rhs
+                if rhs.isOptionalTo(i - 1) and rhs.isOptionalFrom(i + 1):
+                    if su.isNonTerminal:
+                        yield su.symbol, prod
+                else:
+                    break
+
+    def leftRecursionEdges(self, node):
+        """
+        Returns the (non terminal, production) pairs for each non terminal
+        that can start a production of the given non terminal.
+        """
+        for prod in self.productionsFor(node):
+            for symUsage in prod.rhs:
+                if symUsage.isNonTerminal:
+                    yield symUsage.symbol, prod
+                if not symUsage.isOptional:
+                    break
 
     @property
     def cycles(self):
         """
         Returns all cycles.
         """
-        def edge_functor(node):
-            """
-            Returns the edge of the given nonterm
-            For a nt such that:
-
-                S -> alpha1 X1 beta1 |
-                     alpha2 X2 beta2 |
-                     ...
-                     alphaN XN betaN |
-
-            S's neighbouring nodes would be Xk if all of alphak is optional
-            AND all of betak is optional
-            """
-            for prod in self.productionsFor(node):
-                for i, su in enumerate(prod.rhs):
-                    rhs = prod.rhs
-                    if rhs.isOptionalTo(i - 1) and rhs.isOptionalFrom(i + 1):
-                        if su.isNonTerminal:
-                            yield su.symbol, prod
-                    else:
-                        break
+        return graph.all_minimal_cycles(self.nonTerminalsByIndex, self.cycleEdges)
 
-        return graph.all_minimal_cycles(self.nonTerminalsByIndex, edge_functor)
+    @property
+    def cyclicComponents(self):
+        """
+        Returns the groups of non terminals that derive each other through
+        cycles.  Unlike cycles this does not build example cycles and is
+        linear in the size of the grammar.
+        """
+        return graph.cyclic_components(self.nonTerminalsByIndex, self.cycleEdges)
 
     @property
     def leftRecursion(self):
@@ -657,14 +1189,15 @@ class Grammar(object):
         Returns a set of "Starting" non terminals which have atleast
         one production containing left recursion.
         """
-        def edge_functor(node):
-            for prod in self.productionsFor(node):
-                for symUsage in prod.rhs:
-                    if symUsage.isNonTerminal:
-                        yield symUsage.symbol, prod
-                    if not symUsage.isOptional:
-                        break
-        return graph.all_minimal_cycles(self.nonTerminalsByIndex, edge_functor)
+        return graph.all_minimal_cycles(self.nonTerminalsByIndex, self.leftRecursionEdges)
+
+    @property
+    def leftRecursiveComponents(self):
+        """
+        Returns the groups of mutually left recursive non terminals in
+        linear time.
+        """
+        return graph.cyclic_components(self.nonTerminalsByIndex, self.leftRecursionEdges)
 
     def removes(self, symbols, invert=False):
         """
@@ -679,45 +1212,56 @@ class Grammar(object):
                     (invert and nonterm not in symbols):
                 del self.nonTerminalsByIndex[index]
                 del self.nonTerminalsByName[nonterm.name]
-                del self.productions[nonterm.name]
-
-        for nonterm in self.nonTerminalsByName:
-            prodlist = self.productions[nonterm]
-            for index, prod in enumeratex(prodlist, reverse=True, indexed=True):
-                for su in prod.rhs:
-                    if (su.symbol in symbols and not invert) or \
-                            (invert and su.symbol not in symbols):
-                        del prodlist[index]
-                        break
+                prodlist = self.productions.pop(nonterm, None)
+                if prodlist and self._occurrences is not None:
+                    for prod in prodlist:
+                        self._occurrences.remove(prod)
+
+        # Only the productions using one of the removed symbols are affected
+        for name in self.occurrences.using.keys():
+            if (name in symbols and not invert) or \
+                    (invert and name not in symbols):
+                for prod in self.productionsUsing(name):
+                    self.productions[prod.nonterm].removeProduction(prod)
+        self.setModified()
 
     def terminalDerivingSymbols(self):
+        # A production derives a terminal string once all the non terminals
+        # in it do, so keep a count of the non terminals in each production
+        # that are not known to derive one yet and decrement the counts of
+        # the productions using a non terminal as soon as it is found to.
         derives_terminal = set()
-        nadded = -1
-        while nadded != 0:
-            nadded = 0
-            for nonterm, prod in self.allProductions():
-                allDerive = True
-                for su in prod.rhs:
-                    if su.symbol not in derives_terminal:
-                        if su.isTerminal:
-                            derives_terminal.add(su.symbol)
-                            nadded += 1
-                        else:
-                            allDerive = False
-                if allDerive and nonterm not in derives_terminal:
-                    derives_terminal.add(nonterm)
-                    nadded += 1
+        counts = {}
+        queue = collections.deque()
+        for nonterm, prod in self.allProductions():
+            required = set()
+            for su in prod.rhs:
+                if su.isTerminal:
+                    derives_terminal.add(su.symbol)
+                else:
+                    required.add(su.symbol)
+            counts[id(prod)] = len(required)
+            if not required:
+                queue.append(nonterm)
+
+        while queue:
+            nonterm = queue.popleft()
+            if nonterm in derives_terminal:
+                continue
+            derives_terminal.add(nonterm)
+            for prod in self.productionsUsing(nonterm):
+                counts[id(prod)] -= 1
+                if counts[id(prod)] == 0:
+                    queue.append(prod.nonterm)
         return derives_terminal
 
     def reachableSymbols(self, startnt=None):
-        startnt = startnt or self.nonTerminalsByIndex[0]
-        if type(startnt) is str:
-            startnt = self.nonTerminalsByName[startnt]
+        startnt = self.startSymbol(startnt)
 
         reachable = set((startnt,))
-        queue = [startnt]
+        queue = collections.deque([startnt])
         while queue:
-            curr = queue.pop(0)
+            curr = queue.popleft()
             productions = self.productionsFor(curr)
             for prod in productions:
                 for su in prod.rhs:
@@ -756,9 +1300,10 @@ class Grammar(object):
         A -> C
         A -> B C
         """
-        for nonterm in self.nonTerminalsByIndex:
-            self.productions[nonterm].removeNullProductions(self)
-        self.setModified()
+        with self.batchUpdates():
+            for nonterm in self.nonTerminalsByIndex:
+                self.productions[nonterm].removeNullProductions(self)
+                self.productionsChanged(nonterm, removed=True)
 
     def removeLeftRecursionFor(self, nonterm, newnamefunc=None):
         """
@@ -784,39 +1329,108 @@ class Grammar(object):
             return
 
         # Add a new nonterminal that will be right recursive
-        def default_newnamefunc(ntname):
-            count = 1
-            newname = nonterm.name + str(count)
-            while newname in self.nonTerminalsByName:
-                count += 1
-                newname = nonterm.name + str(count)
-            return newname
-
-        newnamefunc = newnamefunc or default_newnamefunc
+        newnamefunc = newnamefunc or self.newNonTerminalName
         newname = newnamefunc(nonterm.name)
         newnonterm = Symbol(newname, nonterm.resultType)
         self.addNonTerminal(newnonterm)
 
-        prodlist = self.productions[nonterm]
-        for index, prod in enumeratex(prodlist, indexed=True, reverse=True):
-            if prod.rhs[0].symbol == nonterm:
-                # we have a left recursion:
-                # A -> A ax
-                # So change to:
-                # remove rule and add following to A'
-                # A' -> ax A'
-                prodlist.removeProduction(index)
-                prod.rhs.append(SymbolUsage(newnonterm, prod.rhs[0].varname))
-                del prod.rhs[0]
-                self.addProduction(newnonterm, prod)
-            else:
-                # We have non left recursive rule:
-                # A -> bk
-                # Replace rule with:
-                # A -> bk A'
-                prod.rhs.append(newnonterm)
-        # finally add the epsilon production
-        self.addProduction(newnonterm, Production(newnonterm, []))
+        with self.batchUpdates():
+            prodlist = self.productions[nonterm]
+            for index, prod in enumeratex(prodlist, indexed=True, reverse=True):
+                if prod.rhs[0].symbol == nonterm:
+                    # we have a left recursion:
+                    # A -> A ax
+                    # So change to:
+                    # remove rule and add following to A'
+                    # A' -> ax A'
+                    prodlist.removeProduction(index)
+                    prod.rhs.append(SymbolUsage(newnonterm, prod.rhs[0].varname))
+                    del prod.rhs[0]
+                    self.addProduction(newnonterm, prod)
+                else:
+                    # We have non left recursive rule:
+                    # A -> bk
+                    # Replace rule with:
+                    # A -> bk A'
+                    prod.rhs.append(newnonterm)
+            prodlist.reindex()
+            self.productionsChanged(nonterm, removed=True)
+            # finally add the epsilon production
+            self.addProduction(newnonterm, Production(newnonterm, []))
+
+    def newNonTerminalName(self, name):
+        """
+        Returns a name derived from the given name that is not yet used by
+        any symbol in the grammar.
+        """
+        count = 1
+        newname = name + str(count)
+        while newname in self.nonTerminalsByName or newname in self.terminalsByName:
+            count += 1
+            newname = name + str(count)
+        return newname
+
+    def leftFactor(self, newnamefunc=None):
+        """
+        Left factors all productions.  For a non terminal, A, productions
+        sharing a common prefix, ie of the form:
+
+            A -> a b1 | a b2 | ... | a bn | c
+
+        are replaced with:
+
+            A -> a A' | c
+            A' -> b1 | b2 | ... | bn
+
+        where a is the longest prefix shared by the group and bk may be
+        empty.  Groups are found with a single pass over the productions of
+        each non terminal, their prefix trees give the length of the shared
+        prefixes and the new non terminals are factored in turn, so in the
+        end no two productions of a non terminal start with the same symbol.
+        Productions with handlers are left out of the groups (and so may
+        still conflict), as their handlers would lose the values of the
+        prefix and their results would end up nested in the reduction of A.
+        """
+        newnamefunc = newnamefunc or self.newNonTerminalName
+        queue = collections.deque(self.nonTerminalsByIndex)
+        with self.batchUpdates():
+            while queue:
+                nonterm = queue.popleft()
+                if nonterm not in self.productions:
+                    continue
+                prodlist = self.productions[nonterm]
+                # the trie is rebuilt on first use after each change to the
+                # productions so hold on to the one the groups come from
+                trie = prodlist.prodsByPrefix
+                groups = collections.OrderedDict()
+                for prod in prodlist:
+                    if prod.rhs and not prod.handler:
+                        groups.setdefault(prod.rhs[0].symbol.name, []).append(prod)
+
+                for first, group in groups.iteritems():
+                    if len(group) < 2:
+                        continue
+                    # the prefix can only extend as far as the optional
+                    # markers of the symbols agree
+                    prefix = group[0].rhs
+                    length = len(trie.children[first].commonPrefix().path)
+                    for i in xrange(length):
+                        if any(prod.rhs[i].isOptional != prefix[i].isOptional for prod in group):
+                            length = i
+                            break
+                    if length == 0:
+                        continue
+
+                    newname = newnamefunc(nonterm.name)
+                    newnonterm = self.addNonTerminal(newname, nonterm.resultType)
+                    for prod in group:
+                        self.removeProduction(nonterm, prod)
+                        self.addProduction(newnonterm, Production(newnonterm, prod.rhs[length:]))
+                    # the new production has no handler so the prefix needs
+                    # no variable names
+                    rhs = [self.symbolUsage(su.symbol, None, su.isOptional) for su in prefix[:length]]
+                    self.addProduction(nonterm, Production(nonterm, rhs + [newnonterm]))
+                    queue.append(newnonterm)
 
     def removeCycles(self):
         """
@@ -826,12 +1440,12 @@ class Grammar(object):
             self.removeNullProductions()
 
         while True:
-            cycles = self.cycles
-            if not cycles:
+            components = self.cyclicComponents
+            if not components:
                 return
-            for start_sym, cycle in cycles:
-                # Find all non terminals in this cycle
-                cycle_symbols = set([sym for rule, sym in cycle])
+            for component in components:
+                # All non terminals in the component derive each other
+                cycle_symbols = set(component)
 
                 # Find the union of all production of all
                 # non terminals in cycle_symbols
@@ -844,14 +1458,16 @@ class Grammar(object):
                 # For each non term in the cycle, add all productions in
                 # prod_union and remove all productions of the form:
                 # M -> N where M and N are BOTH in cycle_symbols
-                for rule, sym in cycle:
-                    prodlist = self.productions[sym]
-                    for index, prod in self.productionsFor(sym, indexed=True, reverse=True):
-                        if prod.rhs.numSymbols == 1 or prod.rhs[0].symbol in cycle_symbols:
-                            prodlist.removeProduction(index)
+                with self.batchUpdates():
+                    for sym in component:
+                        prodlist = self.productions[sym]
+                        for index, prod in self.productionsFor(sym, indexed=True, reverse=True):
+                            if prod.rhs.numSymbols == 1 or prod.rhs[0].symbol in cycle_symbols:
+                                prodlist.removeProduction(index)
 
-                    for prod in prod_union:
-                        prodlist.addProduction(prod.copy(self))
+                        for prod in prod_union:
+                            prodlist.addProduction(prod.copy(self))
+                        self.productionsChanged(sym, removed=True)
 
     def removeLeftRecursion(self, orderer=None):
         """
@@ -866,31 +1482,36 @@ class Grammar(object):
         if self.nullables:
             self.removeNullProductions()
 
-        if self.cycles:
+        if self.cyclicComponents:
             self.removeCycles()
 
         symbols = self.nonTerminalsByIndex[:]
         if orderer:
             symbols = orderer(symbols)
+        order = dict((symbol, i) for i, symbol in enumerate(symbols))
 
-        for i, Ai in enumerate(symbols):
-            print "Symbol Ai: ", i, Ai
-            if Ai not in self.productions:
-                continue
-            for j in xrange(i):
-                Aj = symbols[j]
-                if j == 174:
-                    import ipdb
-                    ipdb.set_trace()
-                if Aj not in self.productions:
+        with self.batchUpdates():
+            for i, Ai in enumerate(symbols):
+                if Ai not in self.productions:
                     continue
-                print "Symbol Aj: ", j, Aj
-                aiprods = self.productions[Ai]
-                for ai, aiprod in enumeratex(aiprods, indexed=True, reverse=True):
-                    if aiprod.rhs[0].symbol == Aj:
-                        aiprods.removeProduction(ai)
-                        ajprods = self.productions[Aj]
-                        for ajprod in enumeratex(ajprods):
+                # Only the Aj (j < i) that productions of Ai start with need
+                # to be substituted.  They are visited in order of j as the
+                # productions replacing Ai -> Aj x start with some Ak, k > j.
+                pending = set()
+                for prod in self.productionsFor(Ai):
+                    if prod.rhs and order.get(prod.rhs[0].symbol, i) < i:
+                        pending.add(order[prod.rhs[0].symbol])
+                heap = list(pending)
+                heapq.heapify(heap)
+                while heap:
+                    j = heapq.heappop(heap)
+                    Aj = symbols[j]
+                    if Aj not in self.productions:
+                        continue
+                    aiprods = [prod for prod in self.productionsStartingWith(Aj) if prod.nonterm == Ai]
+                    for aiprod in reversed(aiprods):
+                        self.removeProduction(Ai, aiprod)
+                        for ajprod in self.productionsFor(Aj):
                             # replace this production:
                             # Ai -> Aj x
                             #
@@ -901,6 +1522,10 @@ class Grammar(object):
                             # Aj -> b1 | b2 | ... | bn
                             newsyms = ajprod.rhs[:] + aiprod.rhs[1:]
                             newprod = Production(Ai, newsyms, aiprod.handler)
-                            aiprods.addProduction(newprod)
-            # Remove left recursion from Ai production if any
-            self.removeLeftRecursionFor(Ai)
+                            self.addProduction(Ai, newprod)
+                            k = order.get(newsyms[0].symbol, i) if newsyms else i
+                            if j < k < i and k not in pending:
+                                pending.add(k)
+                                heapq.heappush(heap, k)
+                # Remove left recursion from Ai production if any
+                self.removeLeftRecursionFor(Ai)
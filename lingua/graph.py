@@ -1,72 +1,149 @@
+import collections
+
 
 def tarjan(nodes, edge_functor):
     """
-    Returns a set of "Starting" non terminals which have atleast
-    one production containing left recursion.
+    Returns the strongly connected components of the graph given by the
+    nodes and the edge_functor (which returns the neighbours of a node).
+
+    Components are returned in the order in which they are completed, ie a
+    component appears only after all the components reachable from it
+    (reverse topological order).
+
+    The search is iterative, so the depth of the graph is not limited by the
+    recursion limit.  Nodes are numbered in the order they are visited and
+    the lowlinks and on stack flags are kept in lists indexed by that
+    number.
     """
-    def strongconnect(currNode, index, indexes, lowlink, stack):
-        indexes[currNode] = index
-        lowlink[currNode] = index
-        index = index + 1
-        stack.insert(0, currNode)
-
-        # consider all rules of currNode which start with a non term
-        for nextNode in edge_functor(currNode):
-            if nextNode not in indexes:
-                # not yet been visited so recurse on it
-                index, _ = strongconnect(nextNode, index, indexes, lowlink, stack)
-                lowlink[currNode] = min(lowlink[currNode], lowlink[nextNode])
-            elif nextNode in stack:
-                # success is in the stack so we are good
-                lowlink[currNode] = min(lowlink[currNode], lowlink[nextNode])
-
-        scc = []
-        if lowlink[currNode] == indexes[currNode]:
-            # start a new strongly connected component
-            while True:
-                nextNT = stack.pop(0)
-                scc.append(nextNT)
-                if nextNT == currNode:
+    indexes = {}        # node -> visit number
+    visited = []        # visit number -> node
+    lowlink = []
+    onStack = []
+    stack = []
+    out = []
+
+    for root in nodes:
+        if root in indexes:
+            continue
+        indexes[root] = len(visited)
+        visited.append(root)
+        lowlink.append(indexes[root])
+        onStack.append(True)
+        stack.append(indexes[root])
+        # each entry is the visit number of a node and the iterator over
+        # the neighbours still to be looked at
+        work = [(indexes[root], iter(edge_functor(root)))]
+        while work:
+            currIndex, neighbours = work[-1]
+            for nextNode in neighbours:
+                nextIndex = indexes.get(nextNode)
+                if nextIndex is None:
+                    # not yet been visited so descend into it
+                    nextIndex = indexes[nextNode] = len(visited)
+                    visited.append(nextNode)
+                    lowlink.append(nextIndex)
+                    onStack.append(True)
+                    stack.append(nextIndex)
+                    work.append((nextIndex, iter(edge_functor(nextNode))))
                     break
-        return index, scc
+                elif onStack[nextIndex] and nextIndex < lowlink[currIndex]:
+                    lowlink[currIndex] = nextIndex
+            else:
+                # all neighbours done
+                work.pop()
+                if lowlink[currIndex] == currIndex:
+                    # start a new strongly connected component
+                    scc = []
+                    while True:
+                        index = stack.pop()
+                        onStack[index] = False
+                        scc.append(visited[index])
+                        if index == currIndex:
+                            break
+                    out.append(scc)
+                if work:
+                    parentIndex = work[-1][0]
+                    if lowlink[currIndex] < lowlink[parentIndex]:
+                        lowlink[parentIndex] = lowlink[currIndex]
+    return out
 
-    out = []
-    index = 0
-    indexes = {}
-    lowlink = {}
-    stack = []
 
-    for currNode in nodes:
-        if currNode not in indexes:
-            index, scc = strongconnect(currNode, index, indexes, lowlink, stack)
+def cyclic_components(nodes, edge_functor):
+    """
+    Returns the strongly connected components of the graph that contain a
+    cycle (more than one node or a node with an edge to itself) in reverse
+    topological order.  This is linear in the size of the graph.
+
+    The edge_functor may return (node, edgeData) tuples instead of nodes.
+    """
+    def neighbours(node):
+        for nextNode in edge_functor(node):
+            if type(nextNode) is tuple:
+                nextNode = nextNode[0]
+            yield nextNode
+
+    out = []
+    for scc in tarjan(nodes, neighbours):
+        if len(scc) > 1 or any(nextNode == scc[0] for nextNode in neighbours(scc[0])):
             out.append(scc)
     return out
 
 
+def shortest_cycle(start, edge_functor, within=None):
+    """
+    Returns the shortest cycle through start as a list of (edgeData, node)
+    pairs, each giving the data of the edge into the node, ending with start.
+    Returns None if start is not on a cycle.  If within is given only those
+    nodes are visited (eg the strongly connected component of start).
+
+    The search is a BFS that only records the parent of each node reached,
+    and the cycle is rebuilt from the parent pointers once start is found.
+    """
+    parents = {}
+    queue = collections.deque([start])
+    while queue:
+        node = queue.popleft()
+        for nextNode in edge_functor(node):
+            edgeData = None
+            if type(nextNode) is tuple:
+                nextNode, edgeData = nextNode
+            if within is not None and nextNode not in within:
+                continue
+            if nextNode == start:
+                cycle = [(edgeData, start)]
+                while node != start:
+                    parentEdgeData, parent = parents[node]
+                    cycle.append((parentEdgeData, node))
+                    node = parent
+                cycle.reverse()
+                return cycle
+            if nextNode not in parents:
+                parents[nextNode] = (edgeData, node)
+                queue.append(nextNode)
+    return None
+
+
 def all_minimal_cycles(nodes, edge_functor):
-    # Tells which cycle a node is assigned to if any
+    """
+    Returns a list of (start, cycle) pairs (with cycles as returned by
+    shortest_cycle) such that every node on a cycle is in at least one of
+    the cycles.
+
+    The cyclic components are found first and a cycle is then searched for
+    only from nodes in those components that are not yet covered, and only
+    within the node's component.
+    """
+    componentOf = {}
+    for scc in cyclic_components(nodes, edge_functor):
+        within = set(scc)
+        for node in scc:
+            componentOf[node] = within
+
     cycles = []
     in_a_cycle = set()
     for node in nodes:
-        # start from node and do a BFS to see what cycle a node appears in
-        if node not in in_a_cycle:
-            start_node = node
-            visited = {}
-            queue = [(node, [])]
-            while queue:
-                node, cycle = queue.pop(0)
-                assert node is not None
-                for nextNode in set(edge_functor(node)):
-                    edgeData = None
-                    if type(nextNode) is tuple:
-                        nextNode, edgeData = nextNode
-                    if nextNode == start_node:
-                        # we have a cycle
-                        cycle.append((edgeData, nextNode))
-                        in_a_cycle.update([n for e, n in cycle])
-                        cycles.append((start_node, cycle))
-                        cycle = cycle[:-1]
-                    elif nextNode not in visited:
-                        visited[nextNode] = True
-                        queue.append((nextNode, cycle[:] + [(edgeData, nextNode)]))
+        if node in componentOf and node not in in_a_cycle:
+            cycle = shortest_cycle(node, edge_functor, componentOf[node])
+            in_a_cycle.update(n for e, n in cycle)
+            cycles.append((node, cycle))
     return cycles
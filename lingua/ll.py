@@ -1,33 +1,463 @@
+import array
+import collections
+import multiprocessing
+import os
+import textwrap
+import jinja2
+import bitsets
+import utils
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+# Templates for each of the backends
+BACKENDS = {
+    "java": "java_ll_parser.tmpl",
+    "python": "python_ll_parser.tmpl",
+    "cpp": "cpp_ll_parser.tmpl",
+}
+
+# Table entry for a (non terminal, terminal) pair with no production
+ERROR = -1
+
+
+class Conflict(collections.namedtuple("Conflict", ["nonterm", "terminal", "productions", "kind"])):
+    """
+    A cell of the LL(1) table that more than one production predicts.  kind
+    is "FIRST/FIRST" if at least two of the productions can start with the
+    terminal, "FIRST/FOLLOW" if one can and the others are nullable
+    productions predicting it through FOLLOW and "FOLLOW/FOLLOW" if only
+    nullable productions predict it.
+
+    A conflict of kind "OPTIONAL" is instead a choice within a single
+    production: the terminal can start one of its optional symbols as well
+    as what follows that symbol, and a parser always takes the optional
+    symbol.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return "%s on %s (%s): %s" % (self.nonterm, self.terminal, self.kind,
+                                      " | ".join(map(repr, self.productions)))
+
+
+class ParseTable(object):
+    """
+    An LL(1) parse table for a grammar.
+
+    Rows are the non terminals in the order of G.nonTerminalsByIndex and
+    columns are the terminals in the order of G.terminalsByIndex followed by
+    the EOF token.  The table is stored as a single dense array of
+    production numbers (indexes into self.productions), with ERROR for
+    cells that no production predicts.  Where more than one production is
+    predicted the first one is kept in the table and the cell is recorded in
+    self.conflicts, as is every terminal that can both start an optional
+    symbol and what follows it.
+    """
+    def __init__(self, G, startnt=None):
+        self.grammar = G
+        self.startSymbol = G.startSymbol(startnt)
+        analysis = G.bitsets
+        self.terminals = analysis.terminals
+        self.nonTerminals = analysis.nonTerminals
+        self.termIndexes = analysis.termIndexes
+        self.nonTermIndexes = analysis.nonTermIndexes
+        self.numColumns = len(self.terminals)
+        self.productions = []
+        # lhsIndexes[p] is the index of the non terminal of production p and
+        # rhsCodes[p] its rhs as a list of (isTerminal, index, isOptional)
+        self.lhsIndexes = []
+        self.rhsCodes = []
+        self.firstMasks = analysis.firstMasks()
+        self.nullableMask = analysis.nullableMask()
+        self.conflicts = []
+        self.table = array.array("i", [ERROR]) * (len(self.nonTerminals) * self.numColumns)
+
+        follow = analysis.followMasks(self.startSymbol)
+        # candidates[cell] lists the (production number, first mask) of
+        # every production predicted for a cell with a conflict
+        candidates = collections.defaultdict(list)
+        prodFirstMasks = []
+        optionalConflicts = []
+        for lhs, prod, rhs in analysis.productions:
+            prodnum = len(self.productions)
+            self.productions.append(prod)
+            self.lhsIndexes.append(lhs)
+            self.rhsCodes.append(rhs)
+            firstFrom, nullableFrom = analysis.suffixMasks(rhs)
+            predict = firstFrom[0]
+            if nullableFrom[0]:
+                predict |= follow.get(lhs, 0)
+            row = lhs * self.numColumns
+            for column in bitsets.bits(predict):
+                cell = row + column
+                existing = self.table[cell]
+                if existing == ERROR:
+                    self.table[cell] = prodnum
+                else:
+                    if cell not in candidates:
+                        candidates[cell].append((existing, prodFirstMasks[existing]))
+                    candidates[cell].append((prodnum, firstFrom[0]))
+            prodFirstMasks.append(firstFrom[0])
+
+            for i, (isTerm, index, isOptional) in enumerate(rhs):
+                if not isOptional:
+                    continue
+                after = firstFrom[i + 1]
+                if nullableFrom[i + 1]:
+                    after |= follow.get(lhs, 0)
+                overlap = after & ((1 << index) if isTerm else self.firstMasks[index])
+                for column in bitsets.bits(overlap):
+                    optionalConflicts.append(Conflict(self.nonTerminals[lhs],
+                                                      self.terminals[column], [prod], "OPTIONAL"))
+
+        for cell in sorted(candidates):
+            lhs, column = divmod(cell, self.numColumns)
+            bit = 1 << column
+            numFirst = len([p for p, fmask in candidates[cell] if fmask & bit])
+            kind = ("FOLLOW/FOLLOW", "FIRST/FOLLOW")[numFirst] if numFirst < 2 else "FIRST/FIRST"
+            self.conflicts.append(Conflict(self.nonTerminals[lhs],
+                                           self.terminals[column],
+                                           [self.productions[p] for p, fmask in candidates[cell]],
+                                           kind))
+        self.conflicts.extend(optionalConflicts)
+
+    @property
+    def isLL1(self):
+        return not self.conflicts
+
+    def entry(self, ntindex, termindex):
+        """
+        Returns the number of the production to expand the non terminal with
+        the given index when the terminal with the given index is next, or
+        ERROR.
+        """
+        return self.table[ntindex * self.numColumns + termindex]
+
+    def productionFor(self, nonterm, terminal):
+        """
+        Returns the production to expand the given non terminal (a symbol or
+        name) with when the given terminal is next, or None.
+        """
+        ntindex = self.nonTermIndexes[getattr(nonterm, "name", nonterm)]
+        termindex = self.termIndexes[getattr(terminal, "name", terminal)]
+        prodnum = self.entry(ntindex, termindex)
+        return None if prodnum == ERROR else self.productions[prodnum]
+
+    def conflictReport(self):
+        """
+        Returns a human readable description of all conflicts in the table.
+        """
+        return "\n".join(map(str, self.conflicts))
+
+    @property
+    def size(self):
+        """
+        Number of entries needed to store the table.
+        """
+        return len(self.table)
+
+    @property
+    def rhsOffsets(self):
+        """
+        The offset of each production's rhs (and then the total length) when
+        the rhsCodes of all productions are laid out end to end.
+        """
+        out = [0]
+        for rhs in self.rhsCodes:
+            out.append(out[-1] + len(rhs))
+        return out
+
+    def firstOf(self, symbol):
+        """
+        Returns the terminals (in column order) that can start the given
+        symbol.
+        """
+        if symbol.name in self.nonTermIndexes:
+            mask = self.firstMasks[self.nonTermIndexes[symbol.name]]
+            return [self.terminals[column] for column in bitsets.bits(mask)]
+        return [self.terminals[self.termIndexes[symbol.name]]]
+
+    def parseMethods(self):
+        """
+        Returns a ParseMethod for each non terminal describing how a
+        recursive descent parser would parse it with this table.
+        """
+        rules = [collections.defaultdict(list) for nonterm in self.nonTerminals]
+        for cell, prodnum in enumerate(self.table):
+            if prodnum != ERROR:
+                row, column = divmod(cell, self.numColumns)
+                rules[row][prodnum].append(self.terminals[column])
+        return [ParseMethod(self, index, rules[index]) for index in xrange(len(self.nonTerminals))]
+
+
+class PackedTable(object):
+    """
+    A compressed form of a ParseTable.
+
+    If useDefaults is True the most common production in each row becomes
+    the row's default and is dropped from the row, so cells that would have
+    been errors expand the default production instead (the error is then
+    reported when the next terminal fails to match).  The remaining entries
+    of all the rows are packed into the single values array by row
+    displacement: row r is stored starting at base[r] such that its entries
+    land on slots no other row uses, and check[i] records the row that owns
+    slot i.  A lookup is then:
+
+        i = base[r] + c
+        values[i] if i < len(check) and check[i] == r else defaults[r]
+
+    The packed table exposes the same attributes and entry method as the
+    ParseTable it was built from so either can be used by the runtime.
+    """
+    def __init__(self, table, useDefaults=True):
+        self.source = table
+        for attr in ("grammar", "startSymbol", "terminals", "nonTerminals",
+                     "termIndexes", "nonTermIndexes", "numColumns",
+                     "productions", "lhsIndexes", "rhsCodes", "firstMasks",
+                     "nullableMask", "conflicts"):
+            setattr(self, attr, getattr(table, attr))
+
+        numColumns = self.numColumns
+        numRows = len(self.nonTerminals)
+        self.defaults = array.array("i", [ERROR]) * numRows
+        self.base = array.array("i", [0]) * numRows
+        rows = []
+        for row in xrange(numRows):
+            entries = table.table[row * numColumns:(row + 1) * numColumns]
+            if useDefaults:
+                counts = collections.defaultdict(int)
+                for prodnum in entries:
+                    if prodnum != ERROR:
+                        counts[prodnum] += 1
+                if counts:
+                    self.defaults[row] = max(counts, key=lambda p: (counts[p], -p))
+            cells = [(column, prodnum) for column, prodnum in enumerate(entries)
+                     if prodnum != ERROR and prodnum != self.defaults[row]]
+            rows.append((row, cells))
+
+        # Place the densest rows first as they are the hardest to fit
+        rows.sort(key=lambda item: (-len(item[1]), item[0]))
+        check = []
+        values = []
+        firstFree = 0
+        for row, cells in rows:
+            if not cells:
+                continue
+            offset = max(firstFree - cells[0][0], 0)
+            while not self.fits(check, offset, cells):
+                offset += 1
+            self.base[row] = offset
+            for column, prodnum in cells:
+                index = offset + column
+                if index >= len(check):
+                    check.extend([ERROR] * (index + 1 - len(check)))
+                    values.extend([ERROR] * (index + 1 - len(values)))
+                check[index] = row
+                values[index] = prodnum
+            while firstFree < len(check) and check[firstFree] != ERROR:
+                firstFree += 1
+        self.check = array.array("i", check)
+        self.values = array.array("i", values)
+
+    @classmethod
+    def fits(cls, check, offset, cells):
+        for column, prodnum in cells:
+            index = offset + column
+            if index < len(check) and check[index] != ERROR:
+                return False
+        return True
+
+    @property
+    def isLL1(self):
+        return not self.conflicts
+
+    def entry(self, ntindex, termindex):
+        """
+        Returns the number of the production to expand the non terminal with
+        the given index when the terminal with the given index is next, or
+        ERROR.
+        """
+        index = self.base[ntindex] + termindex
+        if index < len(self.check) and self.check[index] == ntindex:
+            return self.values[index]
+        return self.defaults[ntindex]
+
+    def productionFor(self, nonterm, terminal):
+        ntindex = self.nonTermIndexes[getattr(nonterm, "name", nonterm)]
+        termindex = self.termIndexes[getattr(terminal, "name", terminal)]
+        prodnum = self.entry(ntindex, termindex)
+        return None if prodnum == ERROR else self.productions[prodnum]
+
+    @property
+    def size(self):
+        """
+        Number of entries needed to store the table.
+        """
+        return len(self.check) + len(self.values) + len(self.base) + len(self.defaults)
+
+
+class ParseRule(object):
+    """
+    A production of a non terminal along with the terminals that select it
+    in the parse table.  The production is tail recursive if its last symbol
+    is its own non terminal (and not optional), in which case a generated
+    parser loops instead of recursing on it.
+    """
+    def __init__(self, table, number, terminals):
+        self.number = number
+        self.production = table.productions[number]
+        self.terminals = terminals
+        rhs = self.production.rhs
+        self.isTailRecursive = (len(rhs) > 0 and not rhs[-1].isOptional and
+                                rhs[-1].symbol.name == self.production.nonterm.name)
+        # The first symbol is known to match if it is a required terminal
+        self.startsWithTerminal = len(rhs) > 0 and rhs[0].isTerminal and not rhs[0].isOptional
+
+    @property
+    def symbols(self):
+        return self.production.rhs
+
+    @property
+    def handler(self):
+        return self.production.handler
+
+    @property
+    def handlerCode(self):
+        """
+        The handler with its common indentation and surrounding blank lines
+        removed so templates can indent it to where it is emitted.
+        """
+        if not self.handler:
+            return self.handler
+        return textwrap.dedent(self.handler.strip("\n")).rstrip()
+
+
+class ParseMethod(object):
+    """
+    The rules for parsing a non terminal, ordered by production number.
+    """
+    def __init__(self, table, index, rules):
+        self.index = index
+        self.nonterm = table.nonTerminals[index]
+        self.rules = [ParseRule(table, prodnum, rules[prodnum]) for prodnum in sorted(rules)]
+        # the loop for tail recursion needs some other rule to end it
+        self.hasTailRecursion = (any(rule.isTailRecursive for rule in self.rules) and
+                                 not all(rule.isTailRecursive for rule in self.rules))
+
+
+# Shared jinja2 environments keyed by bytecode cache directory
+_environments = {}
+
+
+def environment(bytecodeCacheDir=None):
+    """
+    Returns the jinja2 Environment for the templates directory.  One
+    environment is shared by all generators (per bytecode cache directory)
+    so each template is only loaded and compiled once per process.  If a
+    bytecodeCacheDir is given compiled templates are also cached there
+    across processes and builds.
+    """
+    if bytecodeCacheDir not in _environments:
+        bytecodeCache = None
+        if bytecodeCacheDir:
+            utils.ensureDir(bytecodeCacheDir)
+            bytecodeCache = jinja2.FileSystemBytecodeCache(bytecodeCacheDir)
+        _environments[bytecodeCacheDir] = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(TEMPLATES_DIR),
+            trim_blocks=True, lstrip_blocks=True,
+            bytecode_cache=bytecodeCache)
+    return _environments[bytecodeCacheDir]
+
 
 class Parser(object):
     """
-    Generates the LL parser for a particular language.
+    Generates the LL parser for a particular language by rendering the
+    parse methods of a grammar's ParseTable with a template from the
+    templates directory.  The template is given either by name or by the
+    name of a backend in BACKENDS.
     """
-    def __init__(self):
-        pass
+    def __init__(self, templateName="java", bytecodeCacheDir=None):
+        self.templateName = BACKENDS.get(templateName, templateName)
+        self.bytecodeCacheDir = bytecodeCacheDir
+
+    @property
+    def template(self):
+        return environment(self.bytecodeCacheDir).get_template(self.templateName)
 
-    def generate(self, G, startnt):
-        assert len(G.leftRecursion) == 0, "Grammar has left recursion.  Please remove it first"
-        # the predict sets tell which productions should be descended
+    def templateContext(self, G, startnt=None, config=None, packTables=False,
+                        allowConflicts=False):
+        assert not G.leftRecursiveComponents, "Grammar has left recursion.  Please remove it first"
+        options = {"parserClassName": "Parser"}
+        options.update(config or {})
+
+        # the parse table tells which productions should be descended
         # into at any point
-        G.evalPredictSets()
+        table = ParseTable(G, startnt)
+        if table.conflicts and not allowConflicts:
+            raise Exception("Grammar is not LL(1):\n" + table.conflictReport())
+        return {"G": G,
+                "table": table,
+                "methods": table.parseMethods(),
+                "packed": PackedTable(table) if packTables else None,
+                "config": options}
 
+    def generate(self, G, startnt=None, config=None, packTables=False, allowConflicts=False):
+        """
+        Returns the source of the parser for G.  config holds the options for
+        the template (eg parserClassName).  If packTables is True the packed
+        parse table is also emitted for table driven lookups.  An exception
+        listing the conflicts is raised if G is not LL(1) unless
+        allowConflicts is True, in which case the first of the conflicting
+        productions is predicted.
         """
-        The algorithm is:
+        return self.template.render(self.templateContext(G, startnt, config, packTables,
+                                                         allowConflicts))
 
-        # This can be DFS or BFS
-        stack = [ startnt ]
-        visited = {}
-        while stack:
-            top = stack.pop()
-            visited += [top]
-            genCodeForNT(top)
+    def generateTo(self, outfile, G, startnt=None, config=None, packTables=False,
+                   allowConflicts=False):
+        """
+        Like generate but writes the source to outfile (a path or a file
+        object) as it is rendered instead of building it up in memory.
+        """
+        stream = self.template.stream(self.templateContext(G, startnt, config, packTables,
+                                                           allowConflicts))
+        stream.dump(outfile, encoding="utf-8")
 
-        def genCodeForNT(nt, stack, visited):
-            genFunctionSignature(nt, stack, visited)
-            genFunctionBody(nt, stack, visited)
 
-        class Parser(object):
-            def parseA():
-                p1
-        """
+def generateFile(job):
+    """
+    Generates one parser for generateFiles.
+    """
+    # imported here as only the workers need the .pg parser
+    import main
+    grammarPath, outPath, config, options = job
+    G = main.parse_file(grammarPath, options["cachedir"])
+    parser = Parser(options["templateName"], options["bytecodeCacheDir"])
+    parser.generateTo(outPath, G, None, config, options["packTables"],
+                      options["allowConflicts"])
+    return outPath
+
+
+def generateFiles(jobs, templateName="java", processes=None, bytecodeCacheDir=None,
+                  cachedir=None, packTables=False, allowConflicts=False):
+    """
+    Generates a parser for each (grammar file, output file, config) job.
+    Grammars are loaded through the compiled grammar cache in cachedir if
+    given.  Jobs are spread over a pool of processes (by default one per
+    CPU) when there is more than one job and processes is not 1.  Returns
+    the output paths.
+    """
+    options = {"templateName": templateName,
+               "bytecodeCacheDir": bytecodeCacheDir,
+               "cachedir": cachedir,
+               "packTables": packTables,
+               "allowConflicts": allowConflicts}
+    jobs = [(grammarPath, outPath, config, options) for grammarPath, outPath, config in jobs]
+    if processes == 1 or len(jobs) <= 1:
+        return map(generateFile, jobs)
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(generateFile, jobs)
+    finally:
+        pool.close()
+        pool.join()
@@ -1,14 +1,11 @@
 
 # import ipdb
 # import sys
+import collections
+import re
 import StringIO
+import compiled
 import grammar
-import graph
-import utils
-
-reload(grammar)
-reload(graph)
-reload(utils)
 
 TOKEN_ERROR = -1
 TOKEN_EOF = 0
@@ -44,30 +41,82 @@ token_labels = {
 
 
 class Tokenizer(object):
-    def __init__(self, input):
+    """
+    Tokenizer for .pg grammar files.
+
+    The input is read in chunks of CHUNK_SIZE characters into a buffer that
+    is scanned with compiled regexes and string searches instead of one
+    character at a time.  line and column (both 0 based) give the position
+    of the start of the last token returned.
+    """
+    CHUNK_SIZE = 65536
+    SPACES = re.compile(r"\s*")
+    IDENTIFIER = re.compile(r"\w+")
+
+    def __init__(self, input, chunkSize=None):
         self.instream = input
         if type(input) is str:
             self.instream = StringIO.StringIO(input)
-
-        # Create the "core" parser which will be used to parse other files
-        self.prevch = None
+        self.chunkSize = chunkSize or Tokenizer.CHUNK_SIZE
+
+        self.buffer = ''
+        self.pos = 0
+        self.atEof = False
+        # line number at self.pos and the offset in the buffer where that
+        # line starts (which may be negative once the buffer is compacted)
+        self.currLine = 0
+        self.currLineStart = 0
         self.line = 0
         self.column = 0
         self.finished = False
 
-    def reachedEof(self, ch):
-        return ch == '' or ch is None
+    def fill(self):
+        """
+        Reads the next chunk of input into the buffer, discarding the part of
+        the buffer that has already been consumed.  Returns False if the end
+        of the input has been reached.
+        """
+        if self.atEof:
+            return False
+        chunk = self.instream.read(self.chunkSize)
+        if not chunk:
+            self.atEof = True
+            return False
+        self.currLineStart -= self.pos
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def ensure(self, count):
+        """
+        Ensures at least count characters are available in the buffer
+        (unless the input ends first).
+        """
+        while len(self.buffer) - self.pos < count and self.fill():
+            pass
+        return len(self.buffer) - self.pos >= count
 
-    def nextChar(self):
-        if self.prevch:
-            nextch = self.prevch
-            self.prevch = None
-        else:
-            nextch = self.instream.read(1)
-            if nextch in "\n\r":
-                self.line += 1
-                self.column = 0
-        return nextch
+    def advance(self, end):
+        """
+        Moves the read position to the given offset in the buffer while
+        keeping track of line numbers.
+        """
+        newlines = self.buffer.count("\n", self.pos, end)
+        if newlines:
+            self.currLine += newlines
+            self.currLineStart = self.buffer.rfind("\n", self.pos, end) + 1
+        self.pos = end
+
+    def scan(self, regex):
+        """
+        Returns the end of the (possibly empty) match of the regex at the
+        current position, reading more input if the match runs up to the end
+        of the buffer.
+        """
+        end = regex.match(self.buffer, self.pos).end()
+        while end == len(self.buffer) and self.fill():
+            end = regex.match(self.buffer, self.pos).end()
+        return end
 
     def nextToken(self):
         """
@@ -77,10 +126,15 @@ class Tokenizer(object):
             return TOKEN_EOF, None
 
         # skip spaces
-        nextch = self.nextChar()
-        while nextch.isspace():
-            nextch = self.nextChar()
+        self.advance(self.scan(Tokenizer.SPACES))
+        self.line = self.currLine
+        self.column = self.pos - self.currLineStart
+        if not self.ensure(1):
+            self.finished = True
+            return TOKEN_EOF, None
 
+        nextch = self.buffer[self.pos]
+        self.advance(self.pos + 1)
         if nextch == '(':
             return TOKEN_OPAREN, None
         elif nextch == ')':
@@ -90,11 +144,10 @@ class Tokenizer(object):
         elif nextch == ';':
             return TOKEN_SEMICOLON, None
         elif nextch == '{':
-            nextch = self.nextChar()
-            if nextch == '%':
+            if self.ensure(1) and self.buffer[self.pos] == '%':
+                self.advance(self.pos + 1)
                 return self.read_block()
             else:
-                self.prevch = nextch
                 return TOKEN_OBRACE, None
         elif nextch == '}':
             return TOKEN_CBRACE, None
@@ -103,50 +156,53 @@ class Tokenizer(object):
         elif nextch == '?':
             return TOKEN_QMARK, None
         elif nextch == '-':
-            nextch = self.nextChar()
+            if not self.ensure(1):
+                return TOKEN_ERROR, "Expected '>', Found: ''"
+            nextch = self.buffer[self.pos]
+            self.advance(self.pos + 1)
             if nextch != '>':
                 return TOKEN_ERROR, "Expected '>', Found: '%s'" % nextch
             else:
                 return TOKEN_ARROW, None
         elif nextch.isalpha() or nextch.isdigit() or nextch == '_':
-            tok, value, self.prevch = self.read_identifier(nextch)
-            return tok, value
+            self.pos -= 1
+            return self.read_identifier()
         # elif nextch == '"' or nextch == "'":
             # return read_string_literal(nextch)
         else:
-            if self.reachedEof(nextch):
-                return TOKEN_EOF, None
-                self.finished = True
-            else:
-                print "Reached EOF: ", self.reachedEof(nextch)
-                return TOKEN_ERROR, "Invalid character: '%s'" % nextch
-
-    def read_identifier(self, strsofar=''):
-        self.prevch = None
-        nextch = self.nextChar()
-        while nextch.isalnum() or nextch.isdigit() or nextch == '_':
-            strsofar += nextch
-            nextch = self.nextChar()
+            return TOKEN_ERROR, "Invalid character: '%s'" % nextch
 
-        if not self.reachedEof(nextch):
-            self.prevch = nextch
-        return TOKEN_IDENT, strsofar, self.prevch
+    def tokenize(self):
+        """
+        Generator yielding (type, value, line, column) tuples for each token
+        in the input, ending with the TOKEN_EOF token.
+        """
+        while True:
+            toktype, tokvalue = self.nextToken()
+            yield toktype, tokvalue, self.line, self.column
+            if toktype == TOKEN_EOF:
+                return
+
+    def read_identifier(self):
+        end = self.scan(Tokenizer.IDENTIFIER)
+        value = self.buffer[self.pos:end]
+        self.advance(end)
+        return TOKEN_IDENT, value
 
     def read_block(self):
-        out = ''
-        nextch = self.nextChar()
-        while not self.reachedEof(nextch):
-            if nextch == '%':
-                nextch = self.nextChar()
-                if nextch != '}':
-                    out += '%'
-                    out += nextch
-                else:
-                    return TOKEN_BLOCK, out
-            else:
-                out += nextch
-            nextch = self.nextChar()
-        return TOKEN_ERROR, "Unexpected end of file in block"
+        start = self.pos
+        end = self.buffer.find("%}", start)
+        while end < 0:
+            # keep a possible trailing '%' in the search
+            searched = len(self.buffer) - start - 1
+            if not self.fill():
+                self.advance(len(self.buffer))
+                return TOKEN_ERROR, "Unexpected end of file in block"
+            start = self.pos
+            end = self.buffer.find("%}", start + max(searched, 0))
+        value = self.buffer[start:end]
+        self.advance(end + 2)
+        return TOKEN_BLOCK, value
 
 
 class Parser(object):
@@ -183,19 +239,26 @@ class Parser(object):
 
         # Create the "core" parser which will be used to parse other files
         self.tokenizer = Tokenizer(self.instream)
-        self.peekedTokens = []
+        self.tokens = self.tokenizer.tokenize()
+        self.peekedTokens = collections.deque()
 
     def insertToken(self, ttype, tval=None):
-        self.peekedTokens.insert(0, (ttype, tval))
+        line, column = self.tokenizer.line, self.tokenizer.column
+        if self.peekedTokens:
+            line, column = self.peekedTokens[0][2:]
+        self.peekedTokens.appendleft((ttype, tval, line, column))
 
     def peekToken(self, nth=0):
         while len(self.peekedTokens) <= nth:
-            self.peekedTokens.append(self.tokenizer.nextToken())
+            token = next(self.tokens, None)
+            if token is None:
+                token = (TOKEN_EOF, None, self.tokenizer.line, self.tokenizer.column)
+            self.peekedTokens.append(token)
         return self.peekedTokens[nth][0]
 
     def advanceToken(self):
         self.peekToken()
-        toktype, tokvalue = self.peekedTokens.pop(0)
+        toktype, tokvalue, line, column = self.peekedTokens.popleft()
         return tokvalue
 
     def expectAndAdvanceToken(self, token_type):
@@ -205,7 +268,11 @@ class Parser(object):
         if pt != token_type:
             expected = token_labels[token_type]
             found = token_labels[pt]
-            raise Exception("Expected token: %s, Found: %s" % (expected, found))
+            toktype, tokvalue, line, column = self.peekedTokens[0]
+            if tokvalue:
+                found += " (%s)" % tokvalue
+            raise Exception("Expected token: %s, Found: %s at line %d, column %d" %
+                            (expected, found, line + 1, column + 1))
         return self.advanceToken()
 
     def hasToken(self):
@@ -269,7 +336,7 @@ class Parser(object):
 
             if self.peekToken() == TOKEN_BLOCK:
                 handler = self.advanceToken()
-        production = grammar.Production(nonterm, grammar.SymbolString(symbols), handler)
+        production = grammar.Production(nonterm, grammar.SymbolString.fromUsages(symbols), handler)
         G.addProduction(nonterm, production)
 
     def getSymbolUsage(self, G, insideBlock=True):
@@ -295,18 +362,28 @@ class Parser(object):
             symbol = G.addNonTerminal(symbolName)
         else:
             symbol = G.addTerminal(symbolName)
-        return grammar.SymbolUsage(symbol, symbolVar, isOptional)
+        return G.symbolUsage(symbol, symbolVar, isOptional)
 
 
 def tokenize_file(fname):
-    for tok, value in Tokenizer(open(fname)).tokenize():
-        if value:
-            print "Token: ", token_labels[tok], value
-        else:
-            print "Token: ", token_labels[tok]
+    with open(fname) as infile:
+        for tok, value, line, column in Tokenizer(infile).tokenize():
+            if value:
+                print "Token: ", token_labels[tok], value
+            else:
+                print "Token: ", token_labels[tok]
 
 
-def parse_file(filepath):
-    return Parser(open(filepath).read()).parse()
+def parse_file(filepath, cachedir=None):
+    """
+    Parses the grammar in the given file.  If a cachedir is provided the
+    compiled form of the grammar is loaded from (or saved to) there instead,
+    keyed by the contents of the file.
+    """
+    if cachedir:
+        return compiled.loadCached(filepath, cachedir,
+                                   lambda source: Parser(source).parse())
+    with open(filepath) as infile:
+        return Parser(infile).parse()
 
 # g = parse_file("./simple.pg") ; nts = list(g.nonTerminals()) ; g.predictAndFollowSets("S")
@@ -0,0 +1,125 @@
+"""
+A table driven LL(1) parser that runs directly off a Grammar.
+
+Input is any iterable of tokens where each token is a tuple whose first
+item is the name of a terminal in the grammar and whose second item is its
+value.  Any further items are taken to be the line and column of the token
+and are only used in error messages.  Tokens are pulled from the iterable
+one at a time and the parse is driven by an explicit stack of partially
+matched productions instead of recursion, so neither the size of the input
+nor the depth of the parse tree is limited by the Python call stack.
+"""
+import grammar
+import ll
+
+
+class Parser(object):
+    """
+    Parses token streams with an ll.ParseTable or ll.PackedTable.
+
+    handlers maps production handlers to callables.  When a production with
+    a handler in handlers is matched the callable is invoked with the values
+    of each of the symbols in the production (the token value for terminals,
+    the result of the matched production for non terminals and None for
+    optional symbols that were not present) and its return value becomes the
+    value of the production.  Every other production results in a
+    grammar.Reduction.
+    """
+    def __init__(self, table, handlers=None):
+        self.table = table
+        self.handlers = handlers or {}
+        self.eofIndex = len(table.terminals) - 1
+        self.eofName = table.terminals[self.eofIndex].name
+        self.startIndex = table.nonTermIndexes[table.startSymbol.name]
+        # the callable for each production number, or None
+        self.prodHandlers = [self.handlers.get(prod.handler) for prod in table.productions]
+
+    def parse(self, tokens):
+        """
+        Parses the tokens and returns the value of the start symbol.
+        """
+        table = self.table
+        entry = table.entry
+        firstMasks = table.firstMasks
+        rhsCodes = table.rhsCodes
+        productions = table.productions
+        prodHandlers = self.prodHandlers
+        termIndexes = table.termIndexes
+        eofIndex = self.eofIndex
+
+        tokens = iter(tokens)
+
+        def nextToken():
+            token = next(tokens, None)
+            if token is None or token[0] == self.eofName:
+                return eofIndex, token
+            if token[0] not in termIndexes:
+                self.error("Unknown token", token)
+            return termIndexes[token[0]], token
+
+        lookahead, token = nextToken()
+        prodnum = entry(self.startIndex, lookahead)
+        if prodnum == ll.ERROR:
+            self.unexpected(table.startSymbol, token)
+
+        # Each frame is [production number, position in rhs, values]
+        stack = [[prodnum, 0, []]]
+        value = None
+        while stack:
+            frame = stack[-1]
+            prodnum, pos, values = frame
+            rhs = rhsCodes[prodnum]
+            if pos == len(rhs):
+                stack.pop()
+                handler = prodHandlers[prodnum]
+                if handler is not None:
+                    value = handler(*values)
+                else:
+                    value = grammar.Reduction(productions[prodnum], values)
+                if stack:
+                    stack[-1][2].append(value)
+                continue
+
+            frame[1] = pos + 1
+            isTerm, index, isOptional = rhs[pos]
+            if isTerm:
+                if lookahead == index:
+                    values.append(None if token is None else token[1])
+                    lookahead, token = nextToken()
+                elif isOptional:
+                    values.append(None)
+                else:
+                    self.unexpected(table.terminals[index], token)
+            elif isOptional and not firstMasks[index] & (1 << lookahead):
+                values.append(None)
+            else:
+                prodnum = entry(index, lookahead)
+                if prodnum == ll.ERROR:
+                    self.unexpected(table.nonTerminals[index], token)
+                stack.append([prodnum, 0, []])
+
+        if lookahead != eofIndex:
+            self.error("Expected end of input", token)
+        return value
+
+    def unexpected(self, symbol, token):
+        self.error("Unexpected input while parsing %s" % symbol.name, token)
+
+    def error(self, message, token):
+        if token is None:
+            raise Exception("%s, Found: end of input" % message)
+        found = token[0]
+        if token[1] is not None:
+            found += " (%s)" % (token[1],)
+        if len(token) >= 4:
+            raise Exception("%s, Found: %s at line %d, column %d" %
+                            (message, found, token[2] + 1, token[3] + 1))
+        raise Exception("%s, Found: %s" % (message, found))
+
+
+def parse(G, tokens, startnt=None, handlers=None):
+    """
+    Parses the tokens with the grammar G starting from the given non terminal
+    (or the grammar's start symbol).
+    """
+    return Parser(ll.ParseTable(G, startnt), handlers).parse(tokens)
@@ -1,33 +1,147 @@
+import errno
 import itertools
+import os
 
 
 class TrieNode(object):
+    """
+    A node in a prefix tree.  Values are stored at the node at the end of
+    the path (eg the symbols of a production) they were inserted with and
+    children are keyed by the next element of the path.
+    """
+    __slots__ = ("key", "values", "parent", "children", "count")
+
     def __init__(self, key=None, parent=None):
         self.key = key
         self.values = []
         self.parent = parent
-        self.children = []
+        self.children = {}
+        # Number of values stored at or below this node
+        self.count = 0
+
+    @property
+    def path(self):
+        """
+        Returns the path from the root to this node.
+        """
+        out = []
+        node = self
+        while node.parent is not None:
+            out.append(node.key)
+            node = node.parent
+        out.reverse()
+        return out
 
     def findNode(self, path, index=None, create=False):
         """
         Returns the node at the given path.
         """
-        if index is None:
-            index = 0
-        if index >= len(path):
-            # we have reached the end
-            return self
-        for index, child in enumerate(self.children):
-            if child == path[index]:
-                return child.findNode(path, index + 1, create)
-
-        # no path existed so create if asked for it:
-        if not create:
-            return None
-
-        newnode = TrieNode(path[index], self)
-        self.children.append(newnode)
-        return newnode.findNode(path, index + 1, create)
+        node = self
+        for i in xrange(index or 0, len(path)):
+            child = node.children.get(path[i])
+            if child is None:
+                # no path existed so create if asked for it:
+                if not create:
+                    return None
+                child = node.children[path[i]] = TrieNode(path[i], node)
+            node = child
+        return node
+
+    def insert(self, path, value):
+        """
+        Adds a value at the given path and returns the node it was added to.
+        """
+        node = self.findNode(path, create=True)
+        node.values.append(value)
+        curr = node
+        while curr is not None:
+            curr.count += 1
+            curr = curr.parent
+        return node
+
+    def remove(self, path, value):
+        """
+        Removes a value (compared by identity) from the given path.  Nodes
+        left without any values are pruned.  Returns True if the value was
+        found.
+        """
+        node = self.findNode(path)
+        if node is None:
+            return False
+        for index, val in enumerate(node.values):
+            if val is value:
+                del node.values[index]
+                break
+        else:
+            return False
+        while node is not None:
+            node.count -= 1
+            if node.count == 0 and node.parent is not None:
+                del node.parent.children[node.key]
+            node = node.parent
+        return True
+
+    def lookup(self, path):
+        """
+        Returns the values stored at exactly the given path.
+        """
+        node = self.findNode(path)
+        return node.values if node else []
+
+    def longestPrefix(self, path):
+        """
+        Returns the node for the longest prefix of path that exists in the
+        trie.  The length of the prefix is the depth of the node.
+        """
+        node = self
+        for key in path:
+            child = node.children.get(key)
+            if child is None:
+                break
+            node = child
+        return node
+
+    def commonPrefix(self):
+        """
+        Returns the node at the end of the longest path, starting from this
+        node, that is shared by all values at or below this node.
+        """
+        node = self
+        while not node.values and len(node.children) == 1:
+            node = node.children.values()[0]
+        return node
+
+    def itervalues(self):
+        """
+        Iterates over all values at or below this node.
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            for value in node.values:
+                yield value
+            stack.extend(node.children.itervalues())
+
+    def valuesWithPrefix(self, path):
+        """
+        Iterates over all values whose path starts with the given prefix.
+        """
+        node = self.findNode(path)
+        if node is None:
+            return iter([])
+        return node.itervalues()
+
+
+def ensureDir(path):
+    """
+    Creates the directory at the given path (and its parents) unless it
+    already exists.  Safe to call from several processes at once.
+    """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
 
 
 def renumerate(iterable):
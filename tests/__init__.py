@@ -0,0 +1,21 @@
+import glob
+import os
+from lingua import main
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "samples")
+
+
+def samplePath(name):
+    return os.path.join(SAMPLES_DIR, name)
+
+
+def samplePaths():
+    """
+    Returns the paths of all the sample grammars.
+    """
+    return sorted(glob.glob(os.path.join(SAMPLES_DIR, "*.pg")) +
+                  glob.glob(os.path.join(SAMPLES_DIR, "*", "*.pg")))
+
+
+def sampleGrammar(name):
+    return main.parse_file(samplePath(name))
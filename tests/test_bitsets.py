@@ -0,0 +1,44 @@
+import os
+import unittest
+from lingua import main
+from tests import samplePaths
+
+
+class BitsetParityTests(unittest.TestCase):
+    """
+    The bitset engine must agree with the set based analyses of Grammar on
+    every sample grammar.
+    """
+    def checkSample(self, path):
+        G = main.parse_file(path)
+        analysis = G.bitsets
+        name = os.path.basename(path)
+
+        self.assertEqual(G.nullables, analysis.nullables, name)
+
+        firstSets = G.firstSets
+        for symbol, fset in analysis.firstSets.iteritems():
+            self.assertEqual(firstSets.get(symbol, set()), fset, "%s: FIRST(%s)" % (name, symbol))
+
+        for startnt in G.nonTerminalsByIndex:
+            follow = G.followSets(startnt)
+            expected = analysis.followSets(startnt)
+            for nonterm in G.nonTerminalsByIndex:
+                self.assertEqual(follow.get(nonterm, set()), expected.get(nonterm, set()),
+                                 "%s: FOLLOW(%s) from %s" % (name, nonterm, startnt))
+
+        G.evalPredictSets()
+        predictSets = [(prod, prod.predictSet) for nonterm, prod in G.allProductions()]
+        analysis.evalPredictSets()
+        for prod, pset in predictSets:
+            self.assertEqual(pset, prod.predictSet, "%s: PREDICT(%s)" % (name, prod))
+
+    def test_samples(self):
+        paths = samplePaths()
+        self.assertTrue(paths)
+        for path in paths:
+            self.checkSample(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
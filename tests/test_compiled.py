@@ -0,0 +1,128 @@
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+from lingua import compiled, main
+from tests import samplePath
+
+
+def productions(G):
+    return [(repr(prod), prod.handler, [(su.varname, su.isOptional) for su in prod.rhs])
+            for nonterm, prod in G.allProductions()]
+
+
+def seal(data):
+    """
+    Returns data with the checksum in its header updated to match its
+    contents.
+    """
+    header = compiled.HEADER.unpack_from(data, 0)
+    checksum = zlib.crc32(data[compiled.HEADER.size:]) & 0xffffffff
+    return compiled.HEADER.pack(*header[:-1] + (checksum,)) + data[compiled.HEADER.size:]
+
+
+class CompiledGrammarTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.grammarPath = samplePath("leftrec.pg")
+        with open(self.grammarPath, "rb") as infile:
+            self.digest = compiled.sourceHash(infile.read())
+        self.G = main.parse_file(self.grammarPath)
+        self.path = os.path.join(self.tempdir, "grammar.lgc")
+        with open(self.path, "wb") as outfile:
+            compiled.save(self.G, outfile, self.digest)
+        with open(self.path, "rb") as infile:
+            self.data = infile.read()
+
+    def tearDown(self):
+        if hasattr(self, "datafile"):
+            self.datafile.close()
+        shutil.rmtree(self.tempdir)
+
+    def loadData(self, data):
+        # a single handle is rewritten as opening files is slow on some
+        # file systems
+        if not hasattr(self, "datafile"):
+            self.datafile = open(os.path.join(self.tempdir, "data.lgc"), "w+b")
+        self.datafile.seek(0)
+        self.datafile.truncate()
+        self.datafile.write(data)
+        self.datafile.flush()
+        return compiled.load(self.datafile, self.digest)
+
+    def test_round_trip(self):
+        G = self.loadData(self.data)
+        self.assertEqual(productions(G), productions(self.G))
+
+    def test_truncated_files_are_rejected(self):
+        for size in xrange(len(self.data)):
+            self.assertEqual(self.loadData(self.data[:size]), None, "truncated to %d bytes" % size)
+
+    def test_corrupt_files_are_rejected(self):
+        rand = random.Random(1)
+        cachedir = os.path.join(self.tempdir, "cache")
+        main.parse_file(self.grammarPath, cachedir)
+        path = compiled.cachePath(cachedir, self.digest)
+        for i in xrange(500):
+            data = bytearray(self.data)
+            for j in xrange(rand.randint(1, 4)):
+                data[rand.randrange(len(data))] = rand.randrange(256)
+            G = self.loadData(str(data))
+            if str(data) != self.data:
+                self.assertEqual(G, None)
+            if i % 50 == 0:
+                with open(path, "wb") as outfile:
+                    outfile.write(data)
+                G = main.parse_file(self.grammarPath, cachedir)
+                self.assertEqual(productions(G), productions(self.G))
+
+    def test_indexes_out_of_range_are_rejected(self):
+        lengths = compiled.LENGTHS.unpack_from(self.data, compiled.HEADER.size)
+        offsets = {}
+        offset = compiled.HEADER.size + compiled.LENGTHS.size
+        for name, length in zip(compiled.SECTIONS, lengths):
+            offsets[name] = (offset, length)
+            offset += 4 * length
+        # (section, record size, field) of every symbol index and offset
+        fields = [("symbols", 3, 0), ("productions", 4, 0), ("productions", 4, 2),
+                  ("productions", 4, 3), ("usages", 3, 0), ("nullables", 1, 0),
+                  ("firstOffsets", 1, 0), ("firstItems", 1, 0), ("followKeys", 1, 0),
+                  ("followOffsets", 1, 0), ("followItems", 1, 0)]
+        for name, size, field in fields:
+            start, length = offsets[name]
+            for index in xrange(field, length, size):
+                for value in (-1, -3, 1 << 20):
+                    position = start + 4 * index
+                    data = self.data[:position] + struct.pack("<i", value) + self.data[position + 4:]
+                    self.assertEqual(self.loadData(seal(data)), None,
+                                     "%s[%d] = %d" % (name, index, value))
+
+    def test_eof_terminal_round_trip(self):
+        # a terminal of the grammar may be named like the EOF token
+        G = main.Parser("S -> a EOF b ;").parse()
+        path = os.path.join(self.tempdir, "eof.lgc")
+        with open(path, "w+b") as outfile:
+            compiled.save(G, outfile, self.digest)
+            outfile.flush()
+            loaded = compiled.load(outfile, self.digest)
+        self.assertEqual(productions(loaded), productions(G))
+        self.assertEqual([su.symbol for su in loaded.productionsFor("S")[0].rhs],
+                         [loaded.symbolByName(name) for name in ("a", "EOF", "b")])
+
+    def test_corrupt_cache_is_rebuilt(self):
+        cachedir = os.path.join(self.tempdir, "cache")
+        main.parse_file(self.grammarPath, cachedir)
+        path = compiled.cachePath(cachedir, self.digest)
+        with open(path, "r+b") as outfile:
+            outfile.truncate(len(self.data) / 2)
+        G = main.parse_file(self.grammarPath, cachedir)
+        self.assertEqual(productions(G), productions(self.G))
+        with open(path, "rb") as infile:
+            self.assertEqual(infile.read(), self.data)
+
+
+if __name__ == "__main__":
+    unittest.main()
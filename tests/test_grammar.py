@@ -0,0 +1,182 @@
+import unittest
+from lingua import grammar, main
+from tests import sampleGrammar
+
+
+def makeGrammar(rules):
+    """
+    Creates a grammar from (nonterm, [symbol names]) pairs.  Names starting
+    with an upper case letter are non terminals.
+    """
+    G = grammar.Grammar()
+    for nonterm, rhs in rules:
+        G.addNonTerminal(nonterm)
+    for nonterm, rhs in rules:
+        for name in rhs:
+            if name[0].isupper():
+                G.addNonTerminal(name)
+            else:
+                G.addTerminal(name)
+    for nonterm, rhs in rules:
+        addRule(G, nonterm, rhs)
+    return G
+
+
+def addRule(G, nonterm, rhs):
+    nonterm = G.symbolByName(nonterm)
+    G.addProduction(nonterm, grammar.Production(nonterm, [G.symbolByName(name) for name in rhs]))
+
+
+def names(symbols):
+    return set(symbol.name for symbol in symbols)
+
+
+def rhsKey(symbols):
+    return tuple((su.symbol.name, su.isOptional) for su in symbols)
+
+
+def productionKeys(G):
+    return dict((nonterm.name, set(rhsKey(prod.rhs) for prod in prodlist))
+                for nonterm, prodlist in G.productions.iteritems())
+
+
+class AnalysisUpdateTests(unittest.TestCase):
+    def test_follow_sets_computed_in_batch_are_dropped(self):
+        G = makeGrammar([("S", ["A", "B", "b"]),
+                         ("A", ["a"]),
+                         ("B", ["a"])])
+        self.assertEqual(names(G.followSets("S")[G.symbolByName("A")]), set(["a"]))
+        with G.batchUpdates():
+            addRule(G, "B", [])
+            G.followSets("S")
+        self.assertEqual(names(G.followSets("S")[G.symbolByName("A")]), set(["a", "b"]))
+        self.assertEqual(names(G.bitsets.followSets("S")[G.symbolByName("A")]), set(["a", "b"]))
+
+
+class NullableTests(unittest.TestCase):
+    def checkNullables(self, G, expected):
+        self.assertEqual(names(G.nullables), set(expected))
+        self.assertEqual(names(G.bitsets.nullables), set(expected))
+
+    def test_chain(self):
+        G = makeGrammar([("A", ["B"]),
+                         ("B", ["C"]),
+                         ("C", ["D"]),
+                         ("D", []),
+                         ("E", ["A", "x"])])
+        self.checkNullables(G, ["A", "B", "C", "D"])
+
+    def test_all_symbols_nullable(self):
+        G = makeGrammar([("A", ["B", "C"]),
+                         ("B", ["D"]),
+                         ("C", ["A", "D"]),
+                         ("C", []),
+                         ("D", []),
+                         ("E", ["A", "F"]),
+                         ("F", ["F", "x"])])
+        self.checkNullables(G, ["A", "B", "C", "D"])
+
+    def test_optional_symbols(self):
+        G = main.Parser("A -> ?B ?x ; B -> b C ; C -> ?A ; D -> C ?x A ;").parse()
+        self.checkNullables(G, ["A", "C", "D"])
+
+
+class ProductionListTests(unittest.TestCase):
+    def test_find_production(self):
+        G = makeGrammar([("S", ["A", "b"]),
+                         ("S", ["b"]),
+                         ("S", []),
+                         ("A", ["b"])])
+        prodlist = G.productions[G.symbolByName("S")]
+        first = prodlist[0]
+        self.assertIs(prodlist.findProduction(["A", "b"]), first)
+        self.assertIs(prodlist.findProduction([G.symbolByName("A"), G.symbolByName("b")]), first)
+        self.assertIs(prodlist.findProduction(first.rhs), first)
+        self.assertIs(G.findProduction(G.symbolByName("S"), []), prodlist[2])
+        self.assertIsNone(prodlist.findProduction(["b", "A"]))
+        self.assertIsNone(prodlist.findProduction(["A", "b"], "handler"))
+        self.assertIsNone(G.findProduction(G.symbolByName("b"), ["A"]))
+
+    def test_duplicates_are_not_added(self):
+        G = makeGrammar([("S", ["a"]), ("S", ["a"])])
+        S = G.symbolByName("S")
+        self.assertEqual(len(G.productions[S]), 1)
+        # productions with different handlers are not duplicates
+        G.addProduction(S, grammar.Production(S, [G.symbolByName("a")], "handler"))
+        self.assertEqual(len(G.productions[S]), 2)
+        self.assertEqual(G.findProduction(S, ["a"], "handler").handler, "handler")
+
+    def test_index_follows_changes(self):
+        G = makeGrammar([("S", ["a"]), ("S", ["b"]), ("S", ["a", "b"])])
+        prodlist = G.productions[G.symbolByName("S")]
+        first = prodlist[0]
+        del prodlist[0]
+        self.assertIsNone(prodlist.findProduction(["a"]))
+        prodlist.addProduction(first)
+        self.assertIs(prodlist.findProduction(["a"]), first)
+        replacement = grammar.Production(None, [G.symbolByName("b"), G.symbolByName("a")])
+        prodlist[0] = replacement
+        self.assertIsNone(prodlist.findProduction(["b"]))
+        self.assertIs(prodlist.findProduction(["b", "a"]), replacement)
+        self.assertIs(replacement.nonterm, prodlist.nonterm)
+        prodlist.removeProduction(first)
+        self.assertIsNone(prodlist.findProduction(["a"]))
+        self.assertEqual(sorted(rhsKey(prod.rhs) for prod in prodlist),
+                         [(("a", False), ("b", False)), (("b", False), ("a", False))])
+
+
+class LeftFactorTests(unittest.TestCase):
+    def expand(self, G, symbols, newnames):
+        """
+        Yields the rhs keys obtained by substituting the non terminals added
+        by left factoring (which only ever appear at the end of a production).
+        """
+        if symbols and symbols[-1].symbol.name in newnames:
+            for prod in G.productions[symbols[-1].symbol]:
+                for key in self.expand(G, list(symbols[:-1]) + list(prod.rhs), newnames):
+                    yield key
+        else:
+            yield rhsKey(symbols)
+
+    def checkFactored(self, G):
+        before = productionKeys(G)
+        G.leftFactor()
+        newnames = set(productionKeys(G)) - set(before)
+        for nonterm, prodlist in G.productions.iteritems():
+            starts = [rhsKey(prod.rhs[:1]) for prod in prodlist if prod.rhs and not prod.handler]
+            self.assertEqual(len(starts), len(set(starts)), nonterm.name)
+            if nonterm.name not in newnames:
+                expanded = set()
+                for prod in prodlist:
+                    expanded.update(self.expand(G, prod.rhs, newnames))
+                self.assertEqual(expanded, before[nonterm.name], nonterm.name)
+        return newnames
+
+    def test_swift_samples(self):
+        for name in ("swift.pg", "swift2.pg"):
+            G = sampleGrammar(name)
+            self.assertTrue(self.checkFactored(G), name)
+            self.assertEqual(len(G.productions[G.symbolByName("explicit_member_expression")]), 1)
+
+    def test_productions_with_handlers_are_not_factored(self):
+        G = main.Parser("""
+            E -> NUM:a PLUS NUM:b {% return int(a) + int(b) %}
+              | NUM:a MINUS NUM:b {% return int(a) - int(b) %}
+              | NUM:x TIMES NUM
+              | NUM:y DIVIDE NUM
+              ;
+        """).parse()
+        self.assertEqual(len(self.checkFactored(G)), 1)
+        handlers = sorted(prod.handler.strip() for prod in G.productions[G.symbolByName("E")]
+                          if prod.handler)
+        self.assertEqual(handlers, ["return int(a) + int(b)", "return int(a) - int(b)"])
+        for prod in G.productions[G.symbolByName("E")]:
+            if prod.handler:
+                self.assertEqual([su.varname for su in prod.rhs], ["a", None, "b"])
+            else:
+                # the factored prefix has no handler to bind values for
+                self.assertEqual([su.varname for su in prod.rhs], [None, None])
+
+
+if __name__ == "__main__":
+    unittest.main()
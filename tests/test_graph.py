@@ -0,0 +1,34 @@
+import unittest
+from lingua import graph
+
+# well past the Python recursion limit
+LARGE = 100000
+
+
+class TarjanTests(unittest.TestCase):
+    def test_components_in_reverse_topological_order(self):
+        edges = {"a": ["b"], "b": ["c", "d"], "c": ["a"], "d": ["e"], "e": ["d", "f"], "f": []}
+        neighbours = lambda node: edges[node]
+        sccs = graph.tarjan(sorted(edges), neighbours)
+        self.assertEqual([sorted(scc) for scc in sccs], [["f"], ["d", "e"], ["a", "b", "c"]])
+        sccs = graph.cyclic_components(sorted(edges), neighbours)
+        self.assertEqual([sorted(scc) for scc in sccs], [["d", "e"], ["a", "b", "c"]])
+
+    def test_long_chain(self):
+        neighbours = lambda node: [node + 1] if node + 1 < LARGE else []
+        sccs = graph.tarjan(range(LARGE), neighbours)
+        self.assertEqual(sccs, [[node] for node in reversed(range(LARGE))])
+        self.assertEqual(graph.cyclic_components(range(LARGE), neighbours), [])
+
+    def test_long_cycle(self):
+        sccs = graph.tarjan(range(LARGE), lambda node: [(node + 1) % LARGE])
+        self.assertEqual(len(sccs), 1)
+        self.assertEqual(sorted(sccs[0]), range(LARGE))
+        # starting part way round the cycle makes no difference
+        sccs = graph.tarjan([LARGE / 2], lambda node: [(node + 1) % LARGE])
+        self.assertEqual(len(sccs), 1)
+        self.assertEqual(len(sccs[0]), LARGE)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,322 @@
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import unittest
+from distutils.spawn import find_executable
+from lingua import grammar, ll, main, runtime
+from tests import sampleGrammar
+
+try:
+    import javalang
+except ImportError:
+    javalang = None
+
+# an optional non terminal that can only derive the empty string has an
+# empty FIRST set
+EMPTY_FIRST_GRAMMAR = """
+S -> a ?B:x c ;
+B -> ;
+"""
+
+# handlers with and without a return statement
+HANDLER_GRAMMAR = """
+S -> A:a STOP {% System.out.println(a); %}
+A -> NUM:n {% return n; %} | ID {% int x = 1; %}
+"""
+
+# only the tail recursive production of L is in the table as L is not
+# reachable from S
+UNREACHABLE_LIST_GRAMMAR = """
+S -> NUM ;
+L -> ITEM L | ;
+"""
+
+LIST_GRAMMAR = """
+S -> L END ;
+L -> ITEM ?SEP L | ;
+"""
+
+# Parses the token types read from stdin with values of 1 and prints the
+# status and the sum of the values
+CPP_DRIVER = """
+#include "Parser.h"
+#include <cstdio>
+#include <vector>
+
+struct VectorTokenizer
+{
+    std::vector<int> types;
+    size_t pos = (size_t)-1;
+    bool moveForward() { return ++pos < types.size(); }
+    int tokenType() const { return types[pos]; }
+    long tokenValue() const { return 1; }
+};
+
+struct Sum
+{
+    typedef long Value;
+    long reduce(int production, long *values, int count)
+    {
+        long total = 0;
+        for (int i = 0; i < count; i++)
+            total += values[i];
+        return total;
+    }
+};
+
+int main()
+{
+    VectorTokenizer tokenizer;
+    int type;
+    while (scanf("%d", &type) == 1)
+        tokenizer.types.push_back(type);
+    Sum handler;
+    Parser<VectorTokenizer, Sum, 2, 2> parser(tokenizer, handler);
+    long result = 0;
+    int status = parser.parse(result);
+    printf("%d %ld", status, result);
+    return 0;
+}
+"""
+
+
+class ConflictTests(unittest.TestCase):
+    def test_conflicts_raise(self):
+        G = sampleGrammar("withnull1.pg")
+        with self.assertRaises(Exception) as cm:
+            ll.Parser("python").generate(G)
+        self.assertIn("Grammar is not LL(1)", str(cm.exception))
+        self.assertIn("FIRST/FOLLOW", str(cm.exception))
+
+    def test_optional_symbol_conflicts(self):
+        # a parser enters the optional symbol on "a" and then fails to find
+        # the "a" that has to follow
+        for source in ("S -> ?A a ; A -> a ;", "S -> ?a a ;"):
+            table = ll.ParseTable(main.Parser(source).parse())
+            self.assertFalse(table.isLL1, source)
+            self.assertEqual([(str(c.nonterm), str(c.terminal), c.kind) for c in table.conflicts],
+                             [("S", "a", "OPTIONAL")], source)
+            self.assertIn("S on a (OPTIONAL)", table.conflictReport())
+            with self.assertRaises(Exception):
+                ll.Parser("python").generate(main.Parser(source).parse())
+
+    def test_conflicts_allowed(self):
+        G = sampleGrammar("withnull1.pg")
+        self.assertIn("def parse_A", ll.Parser("python").generate(G, allowConflicts=True))
+
+
+class GeneratedSourceTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def grammars(self):
+        return [("simple", sampleGrammar("simple.pg")),
+                ("nocycles", sampleGrammar("nocycles.pg")),
+                ("csx", sampleGrammar("csx.pg")),
+                ("emptyfirst", main.Parser(EMPTY_FIRST_GRAMMAR).parse()),
+                ("handlers", main.Parser(HANDLER_GRAMMAR).parse()),
+                ("unreachablelist", main.Parser(UNREACHABLE_LIST_GRAMMAR).parse())]
+
+    def completesAbruptly(self, statement):
+        if isinstance(statement, javalang.tree.BlockStatement):
+            return bool(statement.statements) and self.completesAbruptly(statement.statements[-1])
+        return isinstance(statement, (javalang.tree.ReturnStatement, javalang.tree.ThrowStatement,
+                                      javalang.tree.BreakStatement, javalang.tree.ContinueStatement))
+
+    @unittest.skipUnless(javalang, "javalang is not installed")
+    def test_java_parses(self):
+        # Without javac the sources are parsed and checked for the two ways
+        # generated code has failed to compile: a case falling through to
+        # the next one and a while (true) loop that never breaks, which makes
+        # the statements after it unreachable.
+        for name, G in self.grammars():
+            for packTables in (False, True):
+                tree = javalang.parse.parse(ll.Parser("java").generate(G, packTables=packTables))
+                for path, switch in tree.filter(javalang.tree.SwitchStatement):
+                    for case in switch.cases:
+                        self.assertTrue(self.completesAbruptly(case.statements[-1]),
+                                        "%s: case %s falls through" % (name, case.case))
+                for path, loop in tree.filter(javalang.tree.WhileStatement):
+                    if loop.condition.value == "true":
+                        breaks = [node for p, node in loop.filter(javalang.tree.BreakStatement)
+                                  if node.goto == loop.label]
+                        self.assertTrue(breaks, "%s: the loop never ends" % name)
+
+    def test_java_switches_on_packed_table(self):
+        G = sampleGrammar("csx.pg")
+        source = ll.Parser("java").generate(G, packTables=True)
+        self.assertEqual(source.count("switch (lookupProduction("), len(G.nonTerminalsByIndex))
+        self.assertNotIn("case TOKEN_", source)
+
+    @unittest.skipUnless(find_executable("javac"), "javac is not installed")
+    def test_java_compiles(self):
+        for name, G in self.grammars():
+            for packTables in (False, True):
+                outdir = tempfile.mkdtemp(dir=self.tempdir)
+                ll.Parser("java").generateTo(os.path.join(outdir, "Parser.java"), G,
+                                             packTables=packTables)
+                process = subprocess.Popen(["javac", "Parser.java"], cwd=outdir,
+                                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                output = process.communicate()[0]
+                self.assertEqual(process.returncode, 0, "%s:\n%s" % (name, output))
+
+    def buildCpp(self, G, packTables=False):
+        """
+        Builds CPP_DRIVER with the parser for G and returns the path of the
+        executable.
+        """
+        outdir = tempfile.mkdtemp(dir=self.tempdir)
+        with open(os.path.join(outdir, "Parser.h"), "w") as outfile:
+            ll.Parser("cpp").generateTo(outfile, G, packTables=packTables)
+        with open(os.path.join(outdir, "driver.cpp"), "w") as outfile:
+            outfile.write(CPP_DRIVER)
+        process = subprocess.Popen(["g++", "-std=c++17", "-O1", "-o", "driver", "driver.cpp"],
+                                   cwd=outdir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        self.assertEqual(process.returncode, 0, output)
+        return os.path.join(outdir, "driver")
+
+    def runCpp(self, driver, G, names):
+        termIndexes = ll.ParseTable(G).termIndexes
+        process = subprocess.Popen([driver], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        output = process.communicate(" ".join(str(termIndexes[name]) for name in names))[0]
+        self.assertEqual(process.returncode, 0)
+        return tuple(int(value) for value in output.split())
+
+    @unittest.skipUnless(find_executable("g++"), "g++ is not installed")
+    def test_cpp_stacks_grow(self):
+        G = main.Parser(LIST_GRAMMAR).parse()
+        for packTables in (False, True):
+            driver = self.buildCpp(G, packTables)
+            # the list is right recursive so every item nests a level deeper
+            items = ["ITEM", "SEP"] * 5000 + ["ITEM", "END"]
+            self.assertEqual(self.runCpp(driver, G, items), (0, len(items)))
+            self.assertEqual(self.runCpp(driver, G, ["END"]), (0, 1))
+            self.assertEqual(self.runCpp(driver, G, ["ITEM", "ITEM"])[0], 1)
+
+    @unittest.skipUnless(find_executable("g++"), "g++ is not installed")
+    def test_cpp_wide_tables(self):
+        # too many symbols to be stored in 16 bits
+        names = ["t%d" % i for i in xrange(17000)]
+        G = main.Parser("S -> %s ;" % " | ".join(names)).parse()
+        driver = self.buildCpp(G)
+        self.assertEqual(self.runCpp(driver, G, ["t16999"]), (0, 1))
+        self.assertEqual(self.runCpp(driver, G, ["t0", "t1"])[0], 1)
+
+
+def sentence(G, rand, limit=200):
+    """
+    Returns the terminal names of a random sentence of G, or None if the
+    derivation grew past limit symbols.
+    """
+    out = []
+    stack = [G.startSymbol()]
+    while stack:
+        symbol = stack.pop()
+        if symbol.isTerminal:
+            out.append(symbol.name)
+        else:
+            prod = rand.choice(G.productionsFor(symbol))
+            stack.extend(su.symbol for su in reversed(prod.rhs)
+                         if not su.isOptional or rand.random() < 0.5)
+        if len(out) + len(stack) > limit:
+            return None
+    return out
+
+
+class GeneratedPythonTests(unittest.TestCase):
+    """
+    The generated Python parsers must agree with runtime.Parser.
+    """
+    def load(self, G):
+        namespace = {}
+        exec compile(ll.Parser("python").generate(G), "<generated>", "exec") in namespace
+        return namespace
+
+    def tree(self, table, namespace, value):
+        if isinstance(value, namespace["Reduction"]):
+            return (table.productions[value.production].nonterm.name,
+                    [self.tree(table, namespace, child) for child in value.values])
+        if isinstance(value, grammar.Reduction):
+            return (value.production.nonterm.name,
+                    [self.tree(table, namespace, child) for child in value.results])
+        return value
+
+    def parseBoth(self, G, table, namespace, names):
+        """
+        Returns the trees from the generated parser and runtime.Parser for
+        the given terminals, or the type of the error each raised.
+        """
+        results = []
+        tokens = [(namespace["TOKEN_" + name], name.lower()) for name in names]
+        try:
+            results.append(self.tree(table, namespace, namespace["parse"](tokens)))
+        except namespace["ParseError"]:
+            results.append("error")
+        try:
+            value = runtime.Parser(table).parse([(name, name.lower()) for name in names])
+            results.append(self.tree(table, namespace, value))
+        except Exception:
+            results.append("error")
+        return results
+
+    def test_samples(self):
+        rand = random.Random(1)
+        for name in ("simple.pg", "csx.pg", "nocycles.pg"):
+            G = sampleGrammar(name)
+            table = ll.ParseTable(G)
+            namespace = self.load(G)
+            sentences = [names for names in (sentence(G, rand) for i in xrange(200)) if names]
+            self.assertTrue(sentences, name)
+            for names in sentences:
+                generated, expected = self.parseBoth(G, table, namespace, names)
+                self.assertNotEqual(expected, "error", (name, names))
+                self.assertEqual(generated, expected, (name, names))
+                # and both reject the sentence with a token dropped
+                index = rand.randrange(len(names))
+                names = names[:index] + names[index + 1:]
+                generated, expected = self.parseBoth(G, table, namespace, names)
+                self.assertEqual(generated == "error", expected == "error", (name, names))
+
+    def test_errors(self):
+        namespace = self.load(sampleGrammar("simple.pg"))
+        tokens = [(namespace["TOKEN_NUM"], "1", 0, 0), (namespace["TOKEN_OPM"], "*", 0, 2),
+                  (namespace["TOKEN_STOP"], ".", 1, 4)]
+        with self.assertRaises(namespace["ParseError"]) as cm:
+            namespace["parse"](tokens)
+        self.assertEqual(str(cm.exception), "Unexpected STOP while parsing factor at line 2, column 5")
+
+    def test_handlers(self):
+        G = main.Parser("""
+            S -> E:e STOP {% return e %}
+            E -> NUM:a ?R:r {% return int(a) + (r or 0) %}
+            R -> PLUS NUM:b {% return int(b) %}
+        """).parse()
+        namespace = self.load(G)
+        tokens = [(namespace["TOKEN_NUM"], "2"), (namespace["TOKEN_PLUS"], "+"),
+                  (namespace["TOKEN_NUM"], "3"), (namespace["TOKEN_STOP"], "")]
+        self.assertEqual(namespace["parse"](tokens), 5)
+        self.assertEqual(namespace["parse"]([tokens[0], tokens[3]]), 2)
+
+    def test_long_input(self):
+        # Stmts is tail recursive so it is parsed in a loop
+        G = sampleGrammar("csx.pg")
+        table = ll.ParseTable(G)
+        namespace = self.load(G)
+        count = 5000
+        names = ["OBRACE"] + ["ID", "EQUALS", "ID", "SEMICOLON"] * count + ["CBRACE"]
+        stmts = namespace["parse"]([(namespace["TOKEN_" + name], name) for name in names]).values[1]
+        depth = 0
+        while stmts.values:
+            self.assertEqual(table.productions[stmts.values[0].production].nonterm.name, "Stmt")
+            stmts = stmts.values[1]
+            depth += 1
+        self.assertEqual(depth, count)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import StringIO
+import unittest
+from lingua import main
+from tests import samplePaths
+
+# Has tokens of every kind, blocks spanning lines and a "%" inside a block
+TOKENS_TEXT = """Expr : (Node)
+{
+    -> Term:t ?Tail:rest {% return t %}
+    -> NUM ; | _x1
+}
+Tail -> PLUS Term {%
+    return [a % b,
+            c] %}
+"""
+
+
+def tokens(text, chunkSize=None):
+    return list(main.Tokenizer(text, chunkSize).tokenize())
+
+
+class CountingStream(StringIO.StringIO):
+    def __init__(self, text):
+        StringIO.StringIO.__init__(self, text)
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        return StringIO.StringIO.read(self, size)
+
+
+class TokenizerTests(unittest.TestCase):
+    def test_tokens_and_positions(self):
+        T = main
+        expected = [(T.TOKEN_IDENT, "Expr", 0, 0), (T.TOKEN_COLON, None, 0, 5),
+                    (T.TOKEN_OPAREN, None, 0, 7), (T.TOKEN_IDENT, "Node", 0, 8),
+                    (T.TOKEN_CPAREN, None, 0, 12), (T.TOKEN_OBRACE, None, 1, 0),
+                    (T.TOKEN_ARROW, None, 2, 4), (T.TOKEN_IDENT, "Term", 2, 7),
+                    (T.TOKEN_COLON, None, 2, 11), (T.TOKEN_IDENT, "t", 2, 12),
+                    (T.TOKEN_QMARK, None, 2, 14), (T.TOKEN_IDENT, "Tail", 2, 15),
+                    (T.TOKEN_COLON, None, 2, 19), (T.TOKEN_IDENT, "rest", 2, 20),
+                    (T.TOKEN_BLOCK, " return t ", 2, 25), (T.TOKEN_ARROW, None, 3, 4),
+                    (T.TOKEN_IDENT, "NUM", 3, 7), (T.TOKEN_SEMICOLON, None, 3, 11),
+                    (T.TOKEN_PIPE, None, 3, 13), (T.TOKEN_IDENT, "_x1", 3, 15),
+                    (T.TOKEN_CBRACE, None, 4, 0), (T.TOKEN_IDENT, "Tail", 5, 0),
+                    (T.TOKEN_ARROW, None, 5, 5), (T.TOKEN_IDENT, "PLUS", 5, 8),
+                    (T.TOKEN_IDENT, "Term", 5, 13),
+                    (T.TOKEN_BLOCK, "\n    return [a % b,\n            c] ", 5, 18),
+                    (T.TOKEN_EOF, None, 8, 0)]
+        self.assertEqual(tokens(TOKENS_TEXT), expected)
+
+    def test_small_chunks(self):
+        for path in samplePaths():
+            with open(path) as infile:
+                text = infile.read()
+            expected = tokens(text)
+            for chunkSize in (1, 2, 3):
+                self.assertEqual(tokens(text, chunkSize), expected,
+                                 "%s with chunk size %d" % (path, chunkSize))
+
+    def test_tokens_straddling_chunks(self):
+        # with every chunk size the first chunk boundary falls at a different
+        # offset, splitting each token (and "{%", "%}" and "->") somewhere
+        expected = tokens(TOKENS_TEXT)
+        for chunkSize in range(1, len(TOKENS_TEXT) + 1):
+            self.assertEqual(tokens(TOKENS_TEXT, chunkSize), expected,
+                             "chunk size %d" % chunkSize)
+
+    def test_errors(self):
+        for chunkSize in (None, 1, 2, 3):
+            self.assertEqual(tokens("a {% b %", chunkSize)[1:],
+                             [(main.TOKEN_ERROR, "Unexpected end of file in block", 0, 2),
+                              (main.TOKEN_EOF, None, 0, 8)])
+            self.assertEqual(tokens("a -", chunkSize)[1],
+                             (main.TOKEN_ERROR, "Expected '>', Found: ''", 0, 2))
+            self.assertEqual(tokens("a\n -x", chunkSize)[1],
+                             (main.TOKEN_ERROR, "Expected '>', Found: 'x'", 1, 1))
+            self.assertEqual(tokens("a\n\n  $", chunkSize)[1],
+                             (main.TOKEN_ERROR, "Invalid character: '$'", 2, 2))
+
+    def test_tokenize_is_lazy(self):
+        stream = CountingStream("A -> b c ;\n" * 1000)
+        generator = main.Tokenizer(stream, 64).tokenize()
+        self.assertEqual(next(generator), (main.TOKEN_IDENT, "A", 0, 0))
+        self.assertEqual(next(generator), (main.TOKEN_ARROW, None, 0, 2))
+        self.assertEqual(stream.reads, 1)
+        self.assertEqual(len(list(generator)), 5 * 1000 - 2 + 1)
+
+
+class ParserTests(unittest.TestCase):
+    def test_error_positions(self):
+        with self.assertRaises(Exception) as cm:
+            main.Parser("S -> a ;\nT -> b ; : c ;").parse()
+        self.assertEqual(str(cm.exception),
+                         "Expected token: IDENT, Found: COLON at line 2, column 10")
+
+    def test_lookahead(self):
+        parser = main.Parser("A -> b {% c %}")
+        self.assertEqual(parser.peekToken(3), main.TOKEN_BLOCK)
+        self.assertEqual(parser.peekToken(), main.TOKEN_IDENT)
+        self.assertEqual(parser.advanceToken(), "A")
+        parser.insertToken(main.TOKEN_SEMICOLON)
+        self.assertEqual(parser.peekToken(1), main.TOKEN_ARROW)
+        self.assertEqual([parser.advanceToken() for i in range(4)], [None, None, "b", " c "])
+        self.assertFalse(parser.hasToken())
+        self.assertEqual(parser.peekToken(5), main.TOKEN_EOF)
+
+
+if __name__ == "__main__":
+    unittest.main()
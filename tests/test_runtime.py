@@ -0,0 +1,109 @@
+import unittest
+from lingua import grammar, ll, main, runtime
+from tests import sampleGrammar
+
+
+def tokens(names):
+    return [(name, name.lower()) for name in names]
+
+
+def tree(value):
+    """
+    Returns a Reduction as nested (non terminal, [children]) tuples.
+    """
+    if isinstance(value, grammar.Reduction):
+        return (value.production.nonterm.name, [tree(child) for child in value.results])
+    return value
+
+
+class RuntimeParserTests(unittest.TestCase):
+    def parsers(self, G):
+        table = ll.ParseTable(G)
+        return [runtime.Parser(table), runtime.Parser(ll.PackedTable(table))]
+
+    def assertParseError(self, parser, names, message):
+        with self.assertRaises(Exception) as cm:
+            parser.parse(tokens(names))
+        self.assertEqual(str(cm.exception), message)
+
+    def test_reduction_tree(self):
+        G = sampleGrammar("simple.pg")
+        expected = ("S", [("exp", [("term", [("sfactor", [("factor", ["num"])]),
+                                             ("termtail", [])]),
+                                   ("exptail", ["opa",
+                                                ("term", [("sfactor", [("factor", ["num"])]),
+                                                          ("termtail", [])]),
+                                                ("exptail", [])])]),
+                          "stop"])
+        for parser in self.parsers(G):
+            self.assertEqual(tree(parser.parse(tokens(["NUM", "OPA", "NUM", "STOP"]))), expected)
+
+    def test_handlers(self):
+        G = main.Parser("""
+            S -> E:e STOP {% result %}
+            E -> NUM:a ?R:r {% sum %}
+            R -> PLUS NUM:b {% rest %}
+        """).parse()
+        callables = {"result": lambda e, stop: e,
+                     "sum": lambda a, r: int(a) + (r or 0),
+                     "rest": lambda plus, b: int(b)}
+        handlers = dict((prod.handler, callables[prod.handler.strip()])
+                        for nonterm, prod in G.allProductions())
+        for table in (ll.ParseTable(G), ll.PackedTable(ll.ParseTable(G))):
+            parser = runtime.Parser(table, handlers)
+            self.assertEqual(parser.parse([("NUM", "2"), ("PLUS", "+"), ("NUM", "3"), ("STOP", "")]), 5)
+            self.assertEqual(parser.parse([("NUM", "7"), ("STOP", "")]), 7)
+
+    def test_optional_symbols(self):
+        G = main.Parser("S -> a ?b ?B c ; B -> d ;").parse()
+        for parser in self.parsers(G):
+            self.assertEqual(tree(parser.parse(tokens(["a", "c"]))), ("S", ["a", None, None, "c"]))
+            self.assertEqual(tree(parser.parse(tokens(["a", "b", "d", "c"]))),
+                             ("S", ["a", "b", ("B", ["d"]), "c"]))
+            self.assertParseError(parser, ["a", "b", "b", "c"],
+                                  "Unexpected input while parsing c, Found: b (b)")
+
+    def test_errors(self):
+        parser = runtime.Parser(ll.ParseTable(sampleGrammar("simple.pg")))
+        self.assertParseError(parser, ["NUM", "OPM", "STOP"],
+                              "Unexpected input while parsing factor, Found: STOP (stop)")
+        self.assertParseError(parser, ["NUM"],
+                              "Unexpected input while parsing termtail, Found: end of input")
+        self.assertParseError(parser, [], "Unexpected input while parsing S, Found: end of input")
+        self.assertParseError(parser, ["NUM", "STOP", "NUM"],
+                              "Expected end of input, Found: NUM (num)")
+        self.assertParseError(parser, ["NUM", "FOO"], "Unknown token, Found: FOO (foo)")
+        with self.assertRaises(Exception) as cm:
+            parser.parse([("NUM", "1", 0, 0), ("OPM", "*", 0, 2), ("STOP", ".", 1, 4)])
+        self.assertEqual(str(cm.exception),
+                         "Unexpected input while parsing factor, Found: STOP (.) at line 2, column 5")
+
+    def test_packed_table_errors(self):
+        # the default production of a row is expanded for any terminal, so
+        # errors are found when a terminal fails to match
+        parser = runtime.Parser(ll.PackedTable(ll.ParseTable(sampleGrammar("simple.pg"))))
+        self.assertParseError(parser, ["NUM", "OPM", "STOP"],
+                              "Unexpected input while parsing NUM, Found: STOP (stop)")
+        self.assertParseError(parser, ["NUM"],
+                              "Unexpected input while parsing STOP, Found: end of input")
+
+    def test_long_input(self):
+        # Stmts is right recursive so the parse tree is as deep as the input
+        # is long, well past the Python recursion limit
+        G = sampleGrammar("csx.pg")
+        count = 20000
+        names = ["OBRACE"] + ["ID", "EQUALS", "ID", "SEMICOLON"] * count + ["CBRACE"]
+        for parser in self.parsers(G):
+            result = parser.parse(tokens(names))
+            self.assertEqual(result.production.nonterm.name, "Prog")
+            stmts = result.results[1]
+            depth = 0
+            while stmts.results:
+                self.assertEqual(stmts.results[0].production.nonterm.name, "Stmt")
+                stmts = stmts.results[1]
+                depth += 1
+            self.assertEqual(depth, count)
+
+
+if __name__ == "__main__":
+    unittest.main()
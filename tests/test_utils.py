@@ -0,0 +1,70 @@
+import unittest
+from lingua.utils import TrieNode
+
+
+class TrieNodeTests(unittest.TestCase):
+    def setUp(self):
+        self.trie = TrieNode()
+        self.values = {}
+        for path in ("a", "ab", "abc", "abd", "b"):
+            self.values[path] = object()
+            self.trie.insert(list(path), self.values[path])
+
+    def test_insert_and_lookup(self):
+        node = self.trie.insert(list("ab"), "again")
+        self.assertEqual(node.path, ["a", "b"])
+        self.assertEqual(self.trie.lookup(list("ab")), [self.values["ab"], "again"])
+        self.assertEqual(self.trie.lookup(list("abc")), [self.values["abc"]])
+        self.assertEqual(self.trie.lookup(list("abx")), [])
+        self.assertEqual(self.trie.count, 6)
+        self.assertEqual(self.trie.findNode(list("ab")).count, 4)
+
+    def test_remove(self):
+        self.assertTrue(self.trie.remove(list("abc"), self.values["abc"]))
+        self.assertEqual(self.trie.lookup(list("abc")), [])
+        self.assertEqual(self.trie.findNode(list("abc")), None)
+        self.assertEqual(self.trie.findNode(list("ab")).count, 2)
+        # values are compared by identity
+        self.assertFalse(self.trie.remove(list("abd"), object()))
+        self.assertFalse(self.trie.remove(list("x"), self.values["b"]))
+        self.assertEqual(self.trie.count, 4)
+
+    def test_remove_prefix_of_another_key(self):
+        self.assertTrue(self.trie.remove(list("ab"), self.values["ab"]))
+        self.assertEqual(self.trie.lookup(list("ab")), [])
+        # the node stays as the longer keys pass through it
+        self.assertEqual(self.trie.findNode(list("ab")).count, 2)
+        self.assertEqual(self.trie.lookup(list("abc")), [self.values["abc"]])
+        self.assertEqual(self.trie.lookup(list("abd")), [self.values["abd"]])
+
+        self.assertTrue(self.trie.remove(list("abc"), self.values["abc"]))
+        self.assertTrue(self.trie.remove(list("abd"), self.values["abd"]))
+        self.assertEqual(self.trie.findNode(list("ab")), None)
+        self.assertEqual(self.trie.lookup(list("a")), [self.values["a"]])
+        self.assertEqual(self.trie.count, 2)
+
+    def test_longest_prefix(self):
+        self.assertEqual(self.trie.longestPrefix(list("abcx")).path, ["a", "b", "c"])
+        self.assertEqual(self.trie.longestPrefix(list("ax")).path, ["a"])
+        self.assertEqual(self.trie.longestPrefix(list("x")).path, [])
+
+    def test_common_prefix(self):
+        node = self.trie.findNode(["a"]).commonPrefix()
+        self.assertEqual(node.path, ["a"])
+        self.trie.remove(["a"], self.values["a"])
+        # the values left below "a" all start with "a b"
+        self.assertEqual(self.trie.findNode(["a"]).commonPrefix().path, ["a", "b"])
+        self.trie.remove(list("ab"), self.values["ab"])
+        self.assertEqual(self.trie.findNode(["a"]).commonPrefix().path, ["a", "b"])
+        self.trie.remove(list("abd"), self.values["abd"])
+        self.assertEqual(self.trie.findNode(["a"]).commonPrefix().path, ["a", "b", "c"])
+
+    def test_values_with_prefix(self):
+        self.assertEqual(set(self.trie.valuesWithPrefix(list("ab"))),
+                         set(self.values[path] for path in ("ab", "abc", "abd")))
+        self.assertEqual(set(self.trie.valuesWithPrefix([])), set(self.values.values()))
+        self.assertEqual(list(self.trie.valuesWithPrefix(list("abx"))), [])
+
+
+if __name__ == "__main__":
+    unittest.main()